@@ -0,0 +1,261 @@
+"""
+Indexed deployment artifact format. Every member is compressed independently
+and the index (at the end of the file) has the offset, size and hash of every
+member, so listing, verifying or extracting a single file doesn't need to
+decompress the whole archive and members can be extracted in parallel.
+
+Layout::
+
+    MAGIC | member data ... | zlib compressed JSON index | footer
+
+The footer is the index offset, the index length, the sha256 of the index and
+MAGIC again.
+
+This module only uses the standard library because it's uploaded and used on
+the servers before the project is installed::
+
+    python artifact.py list ARTIFACT
+    python artifact.py verify ARTIFACT
+    python artifact.py extract ARTIFACT DEST [--jobs=N] [PREFIX ...]
+    python artifact.py cat ARTIFACT NAME
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+MAGIC = b'PSKLART1'
+FOOTER = struct.Struct('>QQ32s8s')
+
+class ArtifactError(Exception):
+    pass
+
+class ArtifactWriter(object):
+    def __init__(self, path, level=6):
+        self.path = path
+        self.level = level
+        self.fh = open(path, 'wb')
+        self.fh.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.index = []
+        self.names = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type:
+            self.fh.close()
+            os.unlink(self.path)
+        else:
+            self.close()
+
+    def _add(self, name, kind, data=b'', mode=0o644, mtime=0, target=None):
+        name = name.strip('/')
+        if name in self.names:
+            raise ArtifactError("Duplicate member %r" % name)
+        self.names.add(name)
+        entry = dict(name=name, type=kind, mode=mode, mtime=int(mtime))
+        if kind == 'file':
+            compressed = zlib.compress(data, self.level)
+            if len(compressed) < len(data):
+                entry['compression'] = 'zlib'
+            else:
+                compressed, entry['compression'] = data, 'none'
+            self.fh.write(compressed)
+            entry.update(offset=self.offset, size=len(data), csize=len(compressed),
+                         sha256=hashlib.sha256(data).hexdigest())
+            self.offset += len(compressed)
+        elif kind == 'symlink':
+            entry['target'] = target
+        self.index.append(entry)
+
+    def _add_link(self, name, target, mode, mtime):
+        "Add a file that has the same data as the `target` entry."
+        name = name.strip('/')
+        if name in self.names:
+            raise ArtifactError("Duplicate member %r" % name)
+        self.names.add(name)
+        entry = dict(target, name=name, mode=mode, mtime=int(mtime))
+        self.index.append(entry)
+
+    def add_bytes(self, name, data, mode=0o644, mtime=0):
+        self._add(name, 'file', data, mode, mtime)
+
+    def add_file(self, name, path):
+        stat = os.stat(path)
+        with open(path, 'rb') as fh:
+            self._add(name, 'file', fh.read(), stat.st_mode & 0o7777, stat.st_mtime)
+
+    def add_dir(self, name, mode=0o755, mtime=0):
+        self._add(name, 'dir', mode=mode, mtime=mtime)
+
+    def add_symlink(self, name, target):
+        self._add(name, 'symlink', target=target)
+
+    def add_tar(self, archive, prefix='', strip=0, exclude=lambda name: False):
+        """
+        Add the members of an open tarfile (can be a stream), renamed to
+        `prefix` + the name without the first `strip` path components.
+        """
+        # entries of the added files, the hard links to them share the data
+        files = {}
+        for member in archive:
+            parts = member.name.strip('/').split('/')[strip:]
+            if not parts or not parts[0] or exclude('/'.join(parts)):
+                continue
+            name = prefix + '/'.join(parts)
+            if member.isdir():
+                self.add_dir(name, member.mode, member.mtime)
+            elif member.issym():
+                self.add_symlink(name, member.linkname)
+            elif member.islnk():
+                if member.linkname not in files:
+                    raise ArtifactError("Hard link %r points to %r which is not in the artifact" % (
+                        member.name, member.linkname))
+                self._add_link(name, files[member.linkname], member.mode, member.mtime)
+            elif member.isfile():
+                self._add(name, 'file', archive.extractfile(member).read(),
+                          member.mode, member.mtime)
+                files[member.name] = self.index[-1]
+            else:
+                raise ArtifactError("Unsupported member %r (tar type %r)" % (member.name, member.type))
+
+    def close(self):
+        index = zlib.compress(json.dumps(self.index).encode('utf-8'), 9)
+        self.fh.write(index)
+        self.fh.write(FOOTER.pack(self.offset, len(index), hashlib.sha256(index).digest(), MAGIC))
+        self.fh.close()
+
+class Artifact(object):
+    def __init__(self, path):
+        self.path = path
+        self.fh = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            raise ArtifactError("%s is not an artifact" % path)
+        if len(self.data) < len(MAGIC) + FOOTER.size or self.data[:len(MAGIC)] != MAGIC:
+            raise ArtifactError("%s is not an artifact" % path)
+        offset, length, digest, magic = FOOTER.unpack(self.data[-FOOTER.size:])
+        index = self.data[offset:offset + length]
+        if magic != MAGIC or hashlib.sha256(index).digest() != digest:
+            raise ArtifactError("%s has a corrupted index" % path)
+        self.index = json.loads(zlib.decompress(index).decode('utf-8'))
+        self.members = dict((entry['name'], entry) for entry in self.index)
+
+    def close(self):
+        self.data.close()
+        self.fh.close()
+
+    def read(self, name, verify=True):
+        entry = self.members[name]
+        if entry['type'] != 'file':
+            raise ArtifactError("%s is not a file" % name)
+        data = self.data[entry['offset']:entry['offset'] + entry['csize']]
+        if entry['compression'] == 'zlib':
+            data = zlib.decompress(data)
+        if verify and (len(data) != entry['size'] or
+                       hashlib.sha256(data).hexdigest() != entry['sha256']):
+            raise ArtifactError("%s is corrupted" % name)
+        return data
+
+    def verify(self):
+        "Returns the names of the corrupted members."
+        corrupted = []
+        for entry in self.index:
+            if entry['type'] == 'file':
+                try:
+                    self.read(entry['name'])
+                except (ArtifactError, zlib.error):
+                    corrupted.append(entry['name'])
+        return corrupted
+
+    def select(self, prefixes=()):
+        return [entry for entry in self.index
+                if not prefixes or any(entry['name'] == p.rstrip('/') or
+                                       entry['name'].startswith(p.rstrip('/') + '/')
+                                       for p in prefixes)]
+
+    def extract(self, dest, prefixes=(), jobs=None):
+        """
+        Extract the members (all or the ones under `prefixes`) in `dest`. The
+        files are extracted in parallel by `jobs` processes.
+        """
+        entries = self.select(prefixes)
+        for entry in entries:
+            if entry['name'].startswith('/') or '..' in entry['name'].split('/'):
+                raise ArtifactError("Unsafe member name %r" % entry['name'])
+        for entry in entries:
+            if entry['type'] == 'dir':
+                path = os.path.join(dest, entry['name'])
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+        files = [entry['name'] for entry in entries if entry['type'] == 'file']
+        for name in files:
+            parent = os.path.dirname(os.path.join(dest, name))
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+        if jobs == 1 or len(files) < 2:
+            for name in files:
+                _extract_file(self, dest, name)
+        else:
+            from multiprocessing import Pool
+            pool = Pool(jobs, _init_worker, (self.path,))
+            try:
+                pool.map(_extract_worker, [(dest, name) for name in files],
+                         chunksize=max(1, len(files) // ((jobs or 4) * 8)))
+            finally:
+                pool.close()
+                pool.join()
+        for entry in entries:
+            path = os.path.join(dest, entry['name'])
+            if entry['type'] == 'symlink':
+                if os.path.lexists(path):
+                    os.unlink(path)
+                os.symlink(entry['target'], path)
+            elif entry['type'] == 'dir':
+                os.chmod(path, entry['mode'])
+
+def _extract_file(artifact, dest, name):
+    entry = artifact.members[name]
+    path = os.path.join(dest, name)
+    with open(path, 'wb') as fh:
+        fh.write(artifact.read(name))
+    os.chmod(path, entry['mode'])
+    os.utime(path, (entry['mtime'], entry['mtime']))
+
+_worker_artifact = None
+
+def _init_worker(path):
+    global _worker_artifact
+    _worker_artifact = Artifact(path)
+
+def _extract_worker(args):
+    _extract_file(_worker_artifact, *args)
+
+def main(argv):
+    if len(argv) < 2 or argv[0] not in ('list', 'verify', 'extract', 'cat'):
+        sys.exit(__doc__)
+    command, artifact = argv[0], Artifact(argv[1])
+    if command == 'list':
+        for entry in artifact.index:
+            print('%s %10s %s' % (entry['type'][0], entry.get('size', ''), entry['name']))
+    elif command == 'verify':
+        corrupted = artifact.verify()
+        if corrupted:
+            sys.exit("Corrupted members in %s: %s" % (artifact.path, ', '.join(corrupted)))
+        print("%s: %s members OK" % (artifact.path, len(artifact.index)))
+    elif command == 'extract':
+        jobs = [int(arg.split('=', 1)[1]) for arg in argv[3:] if arg.startswith('--jobs=')]
+        artifact.extract(argv[2], [arg for arg in argv[3:] if not arg.startswith('--')],
+                         jobs[0] if jobs else None)
+    elif command == 'cat':
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+        out.write(artifact.read(argv[2]))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,112 @@
+"""
+Celery worker autoscaler driven by the depth of the queues the worker consumes
+from (instead of just the number of reserved tasks).
+
+Enabled with the CELERYD_AUTOSCALER setting and the --autoscale=max,min worker
+option (see CELERY_AUTOSCALE in env.roleconfig). The concurrency is scaled so
+that the expected wait time for the backlog (queue depth / task throughput)
+stays under CELERY_AUTOSCALE_TARGET_LATENCY seconds.
+
+The policy is independent of celery, and the broker is only queried through
+kombu, so both can be exercised with the memory:// transport, eg::
+
+    from kombu import Connection
+    depth = queue_depth(Connection('memory://'), ['default'])
+"""
+import math
+import time
+
+from celery.worker import state
+from celery.worker.autoscale import Autoscaler
+
+class ScalingPolicy(object):
+    def __init__(self, min_concurrency, max_concurrency, target_latency=10.0):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+
+    def latency(self, depth, throughput):
+        "Expected wait time (seconds) for the backlog at the current throughput."
+        if not depth:
+            return 0.0
+        if not throughput:
+            return float('inf')
+        return depth / throughput
+
+    def decide(self, current, depth, throughput, reserved=0):
+        """
+        Returns the number of processes needed for the given queue depth,
+        throughput (tasks/second) and number of reserved (prefetched) tasks.
+        """
+        latency = self.latency(depth, throughput)
+        if latency == float('inf'):
+            needed = current + 1
+        elif latency > self.target_latency:
+            needed = int(math.ceil(current * latency / self.target_latency))
+        elif depth:
+            needed = current
+        else:
+            # no backlog: just enough for what's already reserved
+            needed = reserved
+        return max(self.min_concurrency, min(needed, self.max_concurrency))
+
+def queue_depth(connection, queues):
+    "Total number of ready messages in the queues (doesn't create missing queues)."
+    channel = connection.default_channel
+    depth = 0
+    for name in queues:
+        try:
+            depth += channel.queue_declare(queue=name, passive=True).message_count
+        except connection.channel_errors:
+            channel = connection.channel()
+    return depth
+
+class QueueDepthAutoscaler(Autoscaler):
+    # seconds between broker queries
+    poll_interval = 5.0
+
+    def __init__(self, *args, **kwargs):
+        super(QueueDepthAutoscaler, self).__init__(*args, **kwargs)
+        from django.conf import settings
+        self.policy = ScalingPolicy(
+            self.min_concurrency,
+            self.max_concurrency,
+            getattr(settings, 'CELERY_AUTOSCALE_TARGET_LATENCY', 10.0),
+        )
+        self.connection = None
+        self.last_poll = self.last_count = None
+        self.target = self.min_concurrency
+
+    @property
+    def queues(self):
+        return list(self.worker.app.amqp.queues.consume_from)
+
+    def poll(self):
+        now = time.time()
+        if self.last_poll and now - self.last_poll < self.poll_interval:
+            return
+        if self.connection is None:
+            self.connection = self.worker.app.connection()
+        try:
+            depth = queue_depth(self.connection, self.queues)
+        except self.connection.connection_errors:
+            self.connection.close()
+            self.connection = None
+            return
+        throughput = 0.0
+        completed = sum(state.total_count.values())
+        if self.last_poll:
+            throughput = (completed - self.last_count) / (now - self.last_poll)
+        self.last_poll, self.last_count = now, completed
+        self.target = self.policy.decide(self.processes, depth, throughput,
+                                         len(state.reserved_requests))
+
+    @property
+    def qty(self):
+        self.poll()
+        return max(self.target, len(state.reserved_requests))
+
+    def stop(self):
+        if self.connection is not None:
+            self.connection.close()
+        super(QueueDepthAutoscaler, self).stop()
@@ -0,0 +1,171 @@
+"""
+Nose plugin that keeps N+1 queries and slow views from creeping in: every
+request made through the test client is measured (queries and time, per view)
+and the test fails if the view has a budget and goes over it.
+
+Budgets come from the VIEW_BUDGETS file (in the project root, one
+"<url name, view path or url prefix> <max queries> <max seconds>" per line,
+"-" for no limit) or from the tests, eg::
+
+    @view_budget('article-detail', queries=4, time=0.25)
+    def test_article(self):
+        self.client.get('/articles/1/')
+
+The measurements are saved in .builds/view-budgets.json and the report shows
+the change in query count against the previous run. Enabled with
+NOSE_PLUGINS and NOSE_ARGS = ['--with-view-budgets'] (see settings_local).
+"""
+import json
+import os
+import time
+
+from django.conf import settings
+from django.core.handlers.base import BaseHandler
+from django.core.urlresolvers import Resolver404, resolve
+from django.db import connections
+from nose.plugins import Plugin
+
+def view_budget(view, queries=None, time=None):
+    "Set the budget of `view` for a test method or class."
+    def decorator(obj):
+        budgets = dict(getattr(obj, 'view_budgets', {}))
+        budgets[view] = (queries, time)
+        obj.view_budgets = budgets
+        return obj
+    return decorator
+
+def read_budgets(path):
+    budgets = {}
+    if not os.path.exists(path):
+        return budgets
+    for line in open(path):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        view, queries, seconds = line.split()
+        budgets[view] = (
+            None if queries == '-' else int(queries),
+            None if seconds == '-' else float(seconds),
+        )
+    return budgets
+
+def view_name(request):
+    try:
+        match = resolve(request.path_info)
+    except Resolver404:
+        return request.path_info
+    return match.url_name or '%s.%s' % (match.func.__module__, getattr(match.func, '__name__', type(match.func).__name__))
+
+class ViewBudgets(Plugin):
+    name = 'view-budgets'
+
+    def options(self, parser, env=os.environ):
+        super(ViewBudgets, self).options(parser, env)
+        root = getattr(settings, 'DEPLOYED_ROOT', os.getcwd())
+        parser.add_option('--view-budgets', dest='view_budgets',
+                          default=os.path.join(root, 'VIEW_BUDGETS'),
+                          help="File with the query and time budgets per view.")
+        parser.add_option('--view-budgets-baseline', dest='view_budgets_baseline',
+                          default=os.path.join(root, '.builds', 'view-budgets.json'),
+                          help="Where the measurements are saved (and compared with).")
+
+    def configure(self, options, conf):
+        super(ViewBudgets, self).configure(options, conf)
+        if self.enabled:
+            self.budgets_path = options.view_budgets
+            self.baseline_path = options.view_budgets_baseline
+            self.file_budgets = read_budgets(self.budgets_path)
+            self.test_budgets = {}
+            self.stats = {}
+
+    def begin(self):
+        plugin = self
+        original = self.original_get_response = BaseHandler.get_response
+
+        def get_response(handler, request):
+            return plugin.measure(original, handler, request)
+        BaseHandler.get_response = get_response
+
+    def finalize(self, result):
+        BaseHandler.get_response = self.original_get_response
+
+    def startTest(self, test):
+        test = getattr(test, 'test', test)
+        method = getattr(test, getattr(test, '_testMethodName', ''), None)
+        self.test_budgets = dict(getattr(type(test), 'view_budgets', {}))
+        self.test_budgets.update(getattr(method, 'view_budgets', {}))
+
+    def stopTest(self, test):
+        self.test_budgets = {}
+
+    def budget(self, view, path):
+        for budgets in (self.test_budgets, self.file_budgets):
+            if view in budgets:
+                return budgets[view]
+            prefixes = [prefix for prefix in budgets if prefix.startswith('/') and path.startswith(prefix)]
+            if prefixes:
+                return budgets[max(prefixes, key=len)]
+        return None, None
+
+    def measure(self, get_response, handler, request):
+        databases = connections.all()
+        debug_cursors = [connection.use_debug_cursor for connection in databases]
+        before = [len(connection.queries) for connection in databases]
+        for connection in databases:
+            connection.use_debug_cursor = True
+        start = time.time()
+        try:
+            response = get_response(handler, request)
+        finally:
+            elapsed = time.time() - start
+            queries = 0
+            for connection, count, debug_cursor in zip(databases, before, debug_cursors):
+                queries += len(connection.queries) - count
+                connection.use_debug_cursor = debug_cursor
+        self.check(view_name(request), request.path_info, queries, elapsed)
+        return response
+
+    def check(self, view, path, queries, elapsed):
+        stats = self.stats.setdefault(view, {'requests': 0, 'queries': 0, 'time': 0.0})
+        stats['requests'] += 1
+        stats['queries'] = max(stats['queries'], queries)
+        stats['time'] = max(stats['time'], elapsed)
+        max_queries, max_time = stats['budget'] = self.budget(view, path)
+        if max_queries is not None and queries > max_queries:
+            raise AssertionError("%s (%s) made %s queries, the budget is %s." % (view, path, queries, max_queries))
+        if max_time is not None and elapsed > max_time:
+            raise AssertionError("%s (%s) took %.3fs, the budget is %ss." % (view, path, elapsed, max_time))
+
+    def report(self, stream):
+        if not self.stats:
+            return
+        baseline = {}
+        if os.path.exists(self.baseline_path):
+            with open(self.baseline_path) as fh:
+                baseline = json.load(fh)
+        rows = []
+        for view, stats in sorted(self.stats.items()):
+            previous = baseline.get(view, {}).get('queries')
+            max_queries, max_time = stats['budget']
+            rows.append((
+                view,
+                stats['requests'],
+                stats['queries'],
+                'new' if previous is None else '%+d' % (stats['queries'] - previous),
+                '%.3f' % stats['time'],
+                '%s / %s' % ('-' if max_queries is None else max_queries,
+                             '-' if max_time is None else max_time),
+            ))
+        headers = ('view', 'requests', 'queries', 'change', 'max time', 'budget')
+        widths = [max(len(str(row[i])) for row in rows + [headers]) for i in range(len(headers))]
+        stream.writeln()
+        for row in [headers] + rows:
+            stream.writeln('  '.join(str(cell).ljust(width) for cell, width in zip(row, widths)))
+
+        for view, stats in self.stats.items():
+            baseline[view] = dict((key, stats[key]) for key in ('requests', 'queries', 'time'))
+        directory = os.path.dirname(self.baseline_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.baseline_path, 'w') as fh:
+            json.dump(baseline, fh, indent=2, sort_keys=True)
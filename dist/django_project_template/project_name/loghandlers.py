@@ -0,0 +1,170 @@
+"""
+Logging handlers that keep file writes out of the request path.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+from Queue import Empty, Full, Queue
+
+class BatchingFileHandler(logging.Handler):
+    """
+    A WatchedFileHandler replacement that hands the records to a background
+    thread. The thread writes them in batches and checks once per batch if the
+    file was moved (eg: by logrotate).
+
+    At most `capacity` records are buffered. When the buffer is full `overflow`
+    decides what happens: "drop" discards the new record, "drop_oldest"
+    discards the oldest buffered record and "block" waits for room. The number
+    of discarded records is written in the log.
+
+    The buffer is flushed at exit (including uwsgi worker recycles, like
+    --reload-on-rss).
+    """
+    overflow_policies = ('drop', 'drop_oldest', 'block')
+
+    def __init__(self, filename, mode='a', encoding=None, capacity=10000,
+                 overflow='drop', batch_size=500):
+        if overflow not in self.overflow_policies:
+            raise ValueError("overflow must be one of %s" % ', '.join(self.overflow_policies))
+        logging.Handler.__init__(self)
+        self.filename = os.path.abspath(filename)
+        self.mode = mode
+        self.encoding = encoding
+        self.capacity = capacity
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.stream = None
+        self.dev = self.ino = None
+        self.pid = None
+        self.dropped = 0
+        self.closing = False
+        atexit.register(self.close)
+        try:
+            import uwsgi
+        except ImportError:
+            pass
+        else:
+            previous = getattr(uwsgi, 'atexit', None)
+
+            def uwsgi_atexit():
+                self.close()
+                if previous:
+                    previous()
+            uwsgi.atexit = uwsgi_atexit
+
+    def start(self):
+        # the thread doesn't survive a fork (uwsgi loads the app in the master)
+        self.pid = os.getpid()
+        self.queue = Queue(self.capacity)
+        self.thread = threading.Thread(target=self.run, name='BatchingFileHandler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def prepare(self, record):
+        # merge the args and exception now, they might not be safe to use later
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self.formatter.formatException(record.exc_info) \
+                if self.formatter else logging._defaultFormatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        if self.closing:
+            return
+        try:
+            if self.pid != os.getpid():
+                self.start()
+            record = self.prepare(record)
+            if self.overflow == 'block':
+                self.queue.put(record)
+                return
+            try:
+                self.queue.put_nowait(record)
+            except Full:
+                self.dropped += 1
+                if self.overflow == 'drop_oldest':
+                    try:
+                        self.queue.get_nowait()
+                        self.queue.task_done()
+                        self.queue.put_nowait(record)
+                    except (Empty, Full):
+                        pass
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def open(self):
+        if self.stream:
+            self.stream.close()
+        if self.encoding:
+            import codecs
+            self.stream = codecs.open(self.filename, self.mode, self.encoding)
+        else:
+            self.stream = open(self.filename, self.mode)
+        stat = os.fstat(self.stream.fileno())
+        self.dev, self.ino = stat.st_dev, stat.st_ino
+
+    def reopen_if_moved(self):
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            stat = None
+        if not self.stream or not stat or (stat.st_dev, stat.st_ino) != (self.dev, self.ino):
+            self.open()
+
+    def run(self):
+        queue = self.queue
+        while True:
+            # a timed get is a sleep-poll loop in python 2, close() wakes us up with a None
+            batch = [queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(queue.get_nowait())
+                except Empty:
+                    break
+            stop = None in batch
+            try:
+                self.write([record for record in batch if record is not None])
+            finally:
+                for _ in batch:
+                    queue.task_done()
+            if stop:
+                break
+
+    def write(self, records):
+        lines = []
+        if self.dropped:
+            lines.append("%s BatchingFileHandler dropped %s log records" % (
+                time.strftime('%Y-%m-%d %H:%M:%S'), self.dropped))
+            self.dropped = 0
+        for record in records:
+            try:
+                lines.append(self.format(record))
+            except Exception:
+                self.handleError(record)
+        if not lines:
+            return
+        self.reopen_if_moved()
+        self.stream.write('\n'.join(lines) + '\n')
+        self.stream.flush()
+
+    def flush(self):
+        if self.pid == os.getpid() and self.thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        if self.closing:
+            return
+        self.closing = True
+        if self.pid == os.getpid() and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        logging.Handler.close(self)
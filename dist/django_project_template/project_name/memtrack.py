@@ -0,0 +1,144 @@
+"""
+Opt-in allocation tracking for the app servers (MEMTRACK in env.roleconfig,
+see the app.wsgi templates). Tracks how much memory every request left behind
+(per url, ids replaced with ":id") and writes snapshots of the biggest
+allocation sites in `directory`:
+
+* <pid>-first.json after the first `every` requests
+* <pid>-last.json every `every` requests after that, when the worker gets close
+  to `rss_limit` (MB, what uwsgi's --reload-on-rss recycles at) and at exit
+
+The allocation sites are file:line with tracemalloc (python 3.4+ or a
+patched 2.7), otherwise the gc object counts per type. `fab memory_report`
+downloads the snapshots from all the hosts of a role and ranks the sites and
+the urls by growth.
+"""
+import atexit
+import gc
+import json
+import os
+import re
+import resource
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+URL_ID = re.compile(r'/(?:\d+|[0-9a-f]{32}|[0-9a-f-]{36})(?=/|$)')
+PAGE_SIZE = resource.getpagesize()
+
+def start(frames=1):
+    "Start tracing early (before importing the application) so its allocations are seen too."
+    if tracemalloc and not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+def rss():
+    with open('/proc/self/statm') as fh:
+        return int(fh.read().split()[1]) * PAGE_SIZE
+
+def allocation_sites(limit):
+    "Returns {site: [size, count]} for the biggest `limit` sites."
+    if tracemalloc and tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, os.path.splitext(__file__)[0] + '.py'),
+        ))
+        statistics = snapshot.statistics('lineno')[:limit]
+        return dict(('%s:%s' % (stat.traceback[0].filename, stat.traceback[0].lineno),
+                     [stat.size, stat.count]) for stat in statistics)
+    counts = {}
+    for obj in gc.get_objects():
+        kind = type(obj)
+        counts[kind] = counts.get(kind, 0) + 1
+    biggest = sorted(counts.items(), key=lambda item: -item[1])[:limit]
+    return dict(('%s.%s' % (kind.__module__, kind.__name__), [0, count]) for kind, count in biggest)
+
+class MemoryTracker(object):
+    def __init__(self, application, directory, every=1000, rss_limit=None, limit=500):
+        self.application = application
+        self.directory = directory
+        self.every = every
+        self.rss_limit = rss_limit and rss_limit * 1024 * 1024 * 0.9
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.pid = None
+        atexit.register(self.snapshot, 'exit')
+        try:
+            import uwsgi
+        except ImportError:
+            pass
+        else:
+            previous = getattr(uwsgi, 'atexit', None)
+
+            def uwsgi_atexit():
+                self.snapshot('exit')
+                if previous:
+                    previous()
+            uwsgi.atexit = uwsgi_atexit
+
+    def reset(self):
+        # the counters are per worker (uwsgi loads the app in the master and forks)
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.requests = 0
+        self.paths = {}
+        self.first = True
+        self.near_limit = False
+
+    def used(self):
+        if tracemalloc and tracemalloc.is_tracing():
+            return tracemalloc.get_traced_memory()[0]
+        return rss()
+
+    def __call__(self, environ, start_response):
+        if self.pid != os.getpid():
+            self.reset()
+        before = self.used()
+        try:
+            return self.application(environ, start_response)
+        finally:
+            self.record(URL_ID.sub('/:id', environ.get('PATH_INFO', '/')), self.used() - before)
+
+    def record(self, path, growth):
+        with self.lock:
+            stats = self.paths.setdefault(path, [0, 0, 0])
+            stats[0] += 1
+            stats[1] += growth
+            stats[2] = max(stats[2], growth)
+            self.requests += 1
+            reason = None
+            if self.requests % self.every == 0:
+                reason = 'requests'
+            elif self.rss_limit and not self.near_limit and rss() > self.rss_limit:
+                self.near_limit = True
+                reason = 'rss-limit'
+        if reason:
+            self.snapshot(reason)
+
+    def snapshot(self, reason):
+        if self.pid != os.getpid() or not self.requests:
+            return
+        with self.lock:
+            data = {
+                'pid': self.pid,
+                'reason': reason,
+                'time': time.time(),
+                'started': self.started,
+                'requests': self.requests,
+                'rss': rss(),
+                'tracer': 'tracemalloc' if tracemalloc and tracemalloc.is_tracing() else 'gc',
+                # path: [requests, total growth, max growth] (bytes)
+                'paths': self.paths,
+                'sites': allocation_sites(self.limit),
+            }
+            name = 'first' if self.first else 'last'
+            self.first = False
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, '%s-%s.json' % (self.pid, name))
+        with open(path + '.tmp', 'w') as fh:
+            json.dump(data, fh)
+        os.rename(path + '.tmp', path)
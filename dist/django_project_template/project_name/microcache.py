@@ -0,0 +1,58 @@
+"""
+Keep the nginx micro-cache (MICROCACHE in env.roleconfig) fresh when content
+changes. The cached responses are regenerated by requesting the urls from
+nginx with the X-Microcache-Refresh header (only honored for 127.0.0.1), eg::
+
+    refresh('/', article.get_absolute_url())
+
+or, for every save/delete of a model::
+
+    refresh_on_change(Article, lambda article: ['/', article.get_absolute_url()])
+
+Needs the MICROCACHE_REFRESH_URL setting (eg: "https://127.0.0.1"), when
+it's not set (development) nothing is done. Use `fab purge_cache:PREFIX` to
+drop whole url prefixes.
+"""
+import logging
+import ssl
+import threading
+import urllib2
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+
+logger = logging.getLogger(__name__)
+
+def _refresh(base_url, host, paths):
+    kwargs = {}
+    if hasattr(ssl, '_create_unverified_context'):
+        # it's the local nginx, the certificate is for the public name
+        kwargs['context'] = ssl._create_unverified_context()
+    for path in paths:
+        request = urllib2.Request(base_url.rstrip('/') + path, headers={
+            'Host': host,
+            'X-Microcache-Refresh': '1',
+        })
+        try:
+            urllib2.urlopen(request, timeout=getattr(settings, 'MICROCACHE_REFRESH_TIMEOUT', 30), **kwargs).read()
+        except Exception:
+            logger.warning("Failed to refresh the cached response for %s", path, exc_info=True)
+
+def refresh(*paths):
+    "Regenerates the cached responses for `paths` (in a thread, doesn't delay the caller)."
+    base_url = getattr(settings, 'MICROCACHE_REFRESH_URL', None)
+    if not base_url or not paths:
+        return
+    thread = threading.Thread(target=_refresh, args=(base_url, settings.MICROCACHE_HOST, paths),
+                              name='microcache-refresh')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def refresh_on_change(model, paths):
+    "Refresh the urls returned by `paths(instance)` after an instance of `model` is saved or deleted."
+    def handler(sender, instance, **kwargs):
+        refresh(*paths(instance))
+    uid = 'microcache-%s.%s' % (model._meta.app_label, model._meta.object_name)
+    post_save.connect(handler, sender=model, weak=False, dispatch_uid=uid)
+    post_delete.connect(handler, sender=model, weak=False, dispatch_uid=uid)
@@ -0,0 +1,233 @@
+"""
+Runs management commands on cron-style schedules from a single long-lived
+process. Django is loaded once and every run is forked from the loaded
+process so runs don't pay the interpreter and Django startup.
+
+Usage::
+
+    python -m {{ project_name }}.scheduler path/to/jobs.schedule
+
+The schedule file has a "<minute> <hour> <day> <month> <weekday> <timeout> <command>"
+entry on each line (the timeout is in seconds), eg::
+
+    */5 * * * * 600 mycommand --verbosity=0
+
+A job is skipped if its previous run is still going and it's killed if it runs
+longer than the timeout. Durations and exit codes are logged.
+"""
+import logging
+import os
+import shlex
+import signal
+import sys
+import time
+
+logger = logging.getLogger('{{ project_name }}.scheduler')
+
+# seconds a job gets to exit after SIGTERM before it's killed
+KILL_GRACE = 30
+
+FIELD_RANGES = (
+    (0, 59),  # minute
+    (0, 23),  # hour
+    (1, 31),  # day of month
+    (1, 12),  # month
+    (0, 7),   # day of week (0 and 7 are sunday)
+)
+
+def parse_field(field, low, high):
+    values = set()
+    for part in field.split(','):
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+        else:
+            step = 1
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = [int(i) for i in part.split('-', 1)]
+        else:
+            start = end = int(part)
+            if step != 1:
+                end = high
+        if start < low or end > high:
+            raise ValueError("%r is out of range (%s-%s)" % (field, low, high))
+        values.update(range(start, end + 1, step))
+    return values
+
+class Job(object):
+    def __init__(self, line):
+        parts = line.split(None, 6)
+        if len(parts) != 7:
+            raise ValueError("Invalid schedule line %r" % line)
+        self.fields = [
+            parse_field(field, low, high)
+            for field, (low, high) in zip(parts[:5], FIELD_RANGES)
+        ]
+        if 7 in self.fields[4]:
+            self.fields[4].add(0)
+        self.restricted_day = parts[2] != '*'
+        self.restricted_weekday = parts[4] != '*'
+        self.timeout = int(parts[5])
+        self.command = parts[6]
+        self.args = shlex.split(parts[6])
+        self.pid = None
+        self.started = None
+        self.killed = False
+
+    def __str__(self):
+        return self.command
+
+    def matches(self, moment):
+        minutes, hours, days, months, weekdays = self.fields
+        if moment.tm_min not in minutes or moment.tm_hour not in hours or moment.tm_mon not in months:
+            return False
+        day_match = moment.tm_mday in days
+        weekday_match = (moment.tm_wday + 1) % 7 in weekdays
+        # same as cron: if both the day and the weekday are restricted either can match
+        if self.restricted_day and self.restricted_weekday:
+            return day_match or weekday_match
+        return day_match and weekday_match
+
+def read_schedule(path):
+    jobs = []
+    for line in open(path):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            jobs.append(Job(line))
+    return jobs
+
+def preload(jobs):
+    "Load the settings, the apps and the commands so that forked runs start warm."
+    from django.conf import settings
+    from django.core.management import get_commands, load_command_class
+    from django.db.models.loading import get_apps
+
+    settings.INSTALLED_APPS
+    get_apps()
+    commands = get_commands()
+    for job in jobs:
+        app_name = commands.get(job.args[0])
+        if app_name is None:
+            raise ValueError("Unknown command %r in job %s" % (job.args[0], job))
+        load_command_class(app_name, job.args[0])
+
+def start(job):
+    from django.db import connections
+    for connection in connections.all():
+        connection.close()
+
+    pid = os.fork()
+    if pid:
+        job.pid = pid
+        job.started = time.time()
+        job.killed = False
+        logger.info("Started %s (pid %s)", job, pid)
+        return
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    code = 0
+    try:
+        from django.core.management import ManagementUtility
+        ManagementUtility(['manage.py'] + job.args).execute()
+    except SystemExit as exc:
+        if exc.code is None:
+            code = 0
+        elif isinstance(exc.code, int):
+            code = exc.code
+        else:
+            code = 1
+    except Exception:
+        logger.exception("Job %s failed", job)
+        code = 1
+    finally:
+        logging.shutdown()
+        os._exit(code)
+
+def reap(jobs):
+    running = dict((job.pid, job) for job in jobs if job.pid)
+    while running:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError:
+            break
+        if not pid:
+            break
+        job = running.pop(pid, None)
+        if job is None:
+            continue
+        duration = time.time() - job.started
+        if os.WIFSIGNALED(status):
+            logger.error("Job %s was %s after %.2fs (signal %s)", job,
+                         'killed' if job.killed else 'terminated', duration,
+                         os.WTERMSIG(status))
+        elif os.WEXITSTATUS(status):
+            logger.error("Job %s failed in %.2fs with exit code %s", job, duration,
+                         os.WEXITSTATUS(status))
+        else:
+            logger.info("Job %s finished in %.2fs", job, duration)
+        job.pid = job.started = None
+
+    now = time.time()
+    for job in jobs:
+        if not job.pid or now - job.started < job.timeout:
+            continue
+        if not job.killed:
+            logger.error("Job %s exceeded its %ss timeout, terminating it", job, job.timeout)
+            os.kill(job.pid, signal.SIGTERM)
+            job.killed = True
+        elif now - job.started > job.timeout + KILL_GRACE:
+            os.kill(job.pid, signal.SIGKILL)
+
+def run(jobs):
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    last_minute = int(time.time() // 60)
+    while not stopping:
+        time.sleep(1)
+        reap(jobs)
+        minute = int(time.time() // 60)
+        if minute == last_minute:
+            continue
+        last_minute = minute
+        moment = time.localtime(minute * 60)
+        for job in jobs:
+            if not job.matches(moment):
+                continue
+            if job.pid:
+                logger.warning("Skipping %s, the previous run (pid %s) is still running",
+                               job, job.pid)
+            else:
+                start(job)
+
+    logger.info("Stopping, waiting for %s running jobs", len([job for job in jobs if job.pid]))
+    for job in jobs:
+        if job.pid:
+            os.kill(job.pid, signal.SIGTERM)
+    while any(job.pid for job in jobs):
+        time.sleep(0.5)
+        reap(jobs)
+
+def main(path):
+    jobs = read_schedule(path)
+    preload(jobs)
+    # the LOGGING setting disables loggers that existed before it was loaded
+    logger.disabled = False
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('[%(asctime)s: %(levelname)s] %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.info("Loaded %s jobs from %s", len(jobs), path)
+    run(jobs)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit(__doc__)
+    main(sys.argv[1])
@@ -0,0 +1,64 @@
+"""
+Serve protected files through the web server: the view authorizes the request
+and returns `sendfile(request, path)`, the transfer is done by nginx
+(X-Accel-Redirect) or apache (X-Sendfile, needs mod_xsendfile) so large
+downloads don't keep a python worker busy. Eg::
+
+    @login_required
+    def invoice(request, pk):
+        invoice = get_object_or_404(Invoice, pk=pk, owner=request.user)
+        return sendfile(request, invoice.pdf.path, attachment=True)
+
+The files must be in PROTECTED_MEDIA_ROOT. The SENDFILE_BACKEND setting picks
+the web server ("nginx", "apache" or "django" - streams the file from python,
+for development).
+"""
+import mimetypes
+import os
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousOperation
+from django.core.servers.basehttp import FileWrapper
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, urlquote
+from django.views.static import was_modified_since
+
+def sendfile(request, path, attachment=False, filename=None, max_age=3600, mimetype=None):
+    """
+    Returns a response that makes the web server send the file at `path`.
+    The response is only cacheable by the browser (it's private) for `max_age`
+    seconds and conditional requests get a 304 if the file didn't change.
+    """
+    root = os.path.realpath(settings.PROTECTED_MEDIA_ROOT)
+    path = os.path.realpath(os.path.join(root, path))
+    if not path.startswith(root + os.sep):
+        raise SuspiciousOperation("%r is not in PROTECTED_MEDIA_ROOT" % path)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        raise Http404("%r does not exist" % path)
+
+    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'),
+                              stat.st_mtime, stat.st_size):
+        response = HttpResponseNotModified()
+    else:
+        mimetype = mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        backend = getattr(settings, 'SENDFILE_BACKEND', 'django')
+        if backend == 'nginx':
+            response = HttpResponse(content_type=mimetype)
+            response['X-Accel-Redirect'] = settings.PROTECTED_MEDIA_URL + urlquote(
+                os.path.relpath(path, root))
+        elif backend == 'apache':
+            response = HttpResponse(content_type=mimetype)
+            response['X-Sendfile'] = path.encode('utf-8') if isinstance(path, unicode) else path
+        elif backend == 'django':
+            response = HttpResponse(FileWrapper(open(path, 'rb')), content_type=mimetype)
+            response['Content-Length'] = stat.st_size
+        else:
+            raise ValueError("Unknown SENDFILE_BACKEND %r" % backend)
+        if attachment:
+            response['Content-Disposition'] = 'attachment; filename="%s"' % (
+                filename or os.path.basename(path)).replace('"', '')
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Cache-Control'] = 'private, max-age=%s' % max_age
+    return response
@@ -72,6 +72,22 @@ MEDIA_ROOT = os.path.join(DEPLOYED_ROOT, 'media')
 # Examples: "http://media.lawrence.com/media/", "http://example.com/media/"
 MEDIA_URL = '/media/'
 
+# Absolute path to the directory with files that are only served after a view
+# authorizes the request (see sendfile.py).
+PROTECTED_MEDIA_ROOT = os.path.join(DEPLOYED_ROOT, 'protected-media')
+
+# URL of the internal location for PROTECTED_MEDIA_ROOT (nginx only).
+PROTECTED_MEDIA_URL = '/protected-media/'
+
+# Who sends the protected files: "nginx", "apache" or "django" (no web server).
+SENDFILE_BACKEND = 'django'
+
+# Where microcache.py sends the refresh requests for the nginx micro-cache
+# (MICROCACHE in env.roleconfig), eg: "https://127.0.0.1". None disables it.
+MICROCACHE_REFRESH_URL = None
+# The server name of the role (the Host header of the refresh requests).
+MICROCACHE_HOST = None
+
 # Absolute path to the directory static files should be collected to.
 # Don't put anything in this directory yourself; store your static files
 # in apps' "static/" subdirectories and in STATICFILES_DIRS.
@@ -143,6 +159,15 @@ INSTALLED_APPS = (
     'django_extensions',
 )
 
+# Celery workers started with --autoscale=max,min (CELERY_AUTOSCALE in
+# env.roleconfig) scale on the depth of their queues, keeping the expected
+# wait for the backlog under CELERY_AUTOSCALE_TARGET_LATENCY seconds.
+CELERYD_AUTOSCALER = '{{ project_name }}.autoscale:QueueDepthAutoscaler'
+CELERY_AUTOSCALE_TARGET_LATENCY = 10
+# Use 1 for workers with long tasks (CELERY_LONG_TASKS in env.roleconfig) so
+# they don't hold on to tasks other workers could run.
+CELERYD_PREFETCH_MULTIPLIER = int(os.environ.get('CELERYD_PREFETCH_MULTIPLIER', 4))
+
 # A sample logging configuration. The only tangible logging
 # performed by this configuration is to send an email to
 # the site admins on every HTTP 500 error when DEBUG=False.
@@ -178,9 +203,12 @@ LOGGING = {
         },
         'file': {
             'level':'DEBUG',
-            'class':'logging.handlers.WatchedFileHandler',
+            # writes from a background thread, in batches (see loghandlers.py)
+            'class':'{{ project_name }}.loghandlers.BatchingFileHandler',
             'formatter': 'verbose',
-            'filename': os.path.join(DEPLOYED_ROOT, 'logs/django.log')
+            'filename': os.path.join(DEPLOYED_ROOT, 'logs/django.log'),
+            'capacity': 10000,
+            'overflow': 'drop',
         },
     },
     'loggers': {
@@ -19,4 +19,15 @@ DEBUG_TOOLBAR_CONFIG = {
     'HIDE_DJANGO_SQL': False,
     'ENABLE_STACKTRACES' : True,
 }
-LOGGING['root']['handlers'] = ['console']
\ No newline at end of file
+LOGGING['root']['handlers'] = ['console']
+# run the tests with nose, view query/time budgets are checked (see budgets.py)
+INSTALLED_APPS += (
+    'django_nose',
+)
+TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
+NOSE_PLUGINS = [
+    '{{ project_name }}.budgets.ViewBudgets',
+]
+NOSE_ARGS = [
+    '--with-view-budgets',
+]
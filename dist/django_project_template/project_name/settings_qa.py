@@ -3,4 +3,19 @@ from .settings import *
 # don't repeat connection OPTIONS here, the database server behavior needs to be the same in 
 # development
 DATABASES['default']['NAME'] = '{{ project_name }}_qa'
-LOGGING['handlers']['file']['filename'] = os.path.expanduser("~/logs/{{ project_name }}-qa.django.log")
\ No newline at end of file
+LOGGING['handlers']['file']['filename'] = os.path.expanduser("~/logs/{{ project_name }}-qa.django.log")
+PROTECTED_MEDIA_ROOT = os.path.expanduser("~/protected-media-qa")
+# use "nginx" if you deploy with config_nginx
+SENDFILE_BACKEND = 'apache'
+
+# connect through pgbouncer (templates/supervisord/pgbouncer.*, listens on 6432), set it to True
+# if PGBOUNCER is set for the role (needs config_supervisord in deploy)
+# transaction pooling: don't rely on session state outside transactions
+PGBOUNCER = False
+if PGBOUNCER:
+    DATABASES['default']['HOST'] = os.path.expanduser("~/run/pgbouncer-qa")
+    DATABASES['default']['PORT'] = '6432'
+
+# refresh the nginx micro-cache when content changes (if MICROCACHE is set for the role)
+#MICROCACHE_REFRESH_URL = 'https://127.0.0.1'
+#MICROCACHE_HOST = 'mydomain.com'
@@ -24,14 +24,35 @@ env.roledefs = {
     'qa': ['192.168.106.129'],
     'prod': ['192.168.106.129'],
 }
+# (cron schedule, management command, timeout in seconds) - used for the
+# crontab or, if SCHEDULER is set, for the supervisord scheduler program
+SCHEDULE = [
+    ('* * * * *', 'mycommand', 600),
+]
 env.roleconfig = {
     'qa': {
         'SERVER_NAME': 'mydomain.com',
         'CELERY_WORKER_ARGS': '-Q default -c 6 -E',
         'HTTPD_ALIAS': '/qa',
+        # cache anonymous responses in nginx for 5 seconds (nginx + uwsgi only)
+        #'MICROCACHE': '5s',
+        'SCHEDULE': SCHEDULE,
     },
     'prod': {
-        'CELERY_WORKER_ARGS': '-Q default -c 6 -E',
+        'CELERY_WORKER_ARGS': '-Q default -E',
+        # scale the worker between 2 and 12 processes depending on the queue depth
+        'CELERY_AUTOSCALE': '12,2',
+        # set for workers with long running tasks (disables prefetching)
+        #'CELERY_LONG_TASKS': True,
+        'SCHEDULE': SCHEDULE,
+        # run the SCHEDULE with the scheduler program (supervisord) instead of cron
+        #'SCHEDULER': True,
+        # keep the previous release's uwsgi running for `fab rollback` (nginx + uwsgi only)
+        #'WARM_STANDBY': True,
+        # allocation snapshots every 1000 requests per worker, see `fab memory_report`
+        #'MEMTRACK': 1000,
+        # run pgbouncer with supervisord (set PGBOUNCER in settings_prod too)
+        #'PGBOUNCER': True,
     },
 }
 
@@ -40,7 +61,7 @@ def run(bind_to="0.0.0.0:8000"):
     """
     Run the dev server, eg: fab run:ip:port; fab run
     """
-    manage("syncdb --verbosity=0 --migrate --noinput")
+    migrate(verbosity=0)
     manage("runserver --verbosity=2 --traceback %s" % bind_to)
 
 @task
@@ -75,6 +96,7 @@ def deploy_nginx(glob_pattern="*", **kwargs):
 
 @task
 @require_role
+@record_deploy
 def deploy(what=None, keep=3):
     """
     Deploy the current revision.
@@ -86,7 +108,7 @@ def deploy(what=None, keep=3):
     upload()
     bundlestrap()
     setup_postgresql()
-    fab('manage:"syncdb --migrate --noinput"', version=prj.build_name)
+    fab('migrate', version=prj.build_name)
     fab('manage:"collectstatic --noinput"', version=prj.build_name)
 
     install(
@@ -97,6 +119,7 @@ def deploy(what=None, keep=3):
         # config_nginx(),
         # config_supervisord(),
     )
+    cleanup_standby()
 
     print colors.yellow(" __________________________________________________________")
     print colors.yellow("|                                                          |")
@@ -113,6 +136,7 @@ def setup_db():
     """
     Setup *empty* database (aka syncdb --all and migrate --fake).
     """
+    forget_schema_fingerprint()
     manage("syncdb --all")
     manage("migrate --fake")
 
@@ -126,28 +150,23 @@ def prod_db_backup():
     download("snapshot.sql", "backup-%s.sql" % time.time())
 
 @task
-def sloc():
+def sloc(format='table'):
     """
-    Compute SLOC report using metrics.
+    Compute SLOC report (only changed files are scanned). Eg: fab sloc; fab sloc:json
     """
-    with ctx.lcd(settings.root_path):
-        local(".ve/bin/pip install pygments metrics")
-        local('.ve/bin/metrics -v `find \`cat METRICS\` -type f \( '
-              '-iname "*.css" -or -iname "*.py" -or -iname "*.js" '
-              '-or -iname "*.html" -or -iname "*.txt" '
-              '\) \! -path "*/migrations/*.py" -print` ')
+    sloc_report(format)
 
 @task
 def sloccount():
     """
-    Compute SLOC report using sloccount.
+    Compute SLOC report with a sloccount-style (basic COCOMO) effort estimate.
     """
-    if local("dpkg -s sloccount", quiet=True, capture=True).failed:
-        local("sudo apt-get install sloccount")
-    local('sloccount `find \`cat METRICS\` -type f \( '
-               '-iname "*.css" -or -iname "*.py" -or -iname "*.js" '
-               '-or -iname "*.html" -or -iname "*.txt" '
-               '\) \! -path "*/migrations/*.py" -print` ')
+    ksloc = sloc_report()['total']['code'] / 1000.0
+    effort = 2.4 * ksloc ** 1.05
+    schedule = 2.5 * effort ** 0.38 if effort else 0
+    print "Development Effort Estimate, Person-Months: %.2f" % effort
+    print "Schedule Estimate, Months: %.2f" % schedule
+    print "Estimated Average Number of Developers: %.2f" % (effort / schedule if schedule else 0)
 
 @task
 def makemessages(*languages):
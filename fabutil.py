@@ -6,29 +6,39 @@ __all__ = (
     'settings', 'clean', 'manage', 'require_role', 'bootstrap', 'cleanup_pyc',
     'download', 'sudoshell', 'shell', 'onefab', 'fab', 'version', 'environment',
     'build', 'upload', 'bundlestrap', 'config_apache', 'local',
-    'setup_postgresql', 'prune_builds','rollover_project_link', 'prj',
+    'setup_postgresql', 'prune_builds','rollover_project_link', 'rollback', 'cleanup_standby', 'prj',
     'config_cron', 'install', 'django_admin', 'update_dependency',
     'check_dependency_updates', 'shell', 'confirm', 'config_supervisord',
-    'django_startproject', 'config_nginx', 'silentrun', 'set_tag'
+    'django_startproject', 'config_nginx', 'silentrun', 'set_tag',
+    'latency_report', 'loadtest', 'migrate', 'forget_schema_fingerprint',
+    'sloc_report', 'status', 'purge_cache', 'memory_report',
+    'startup_profile', 'record_deploy', 'deploy_report'
 )
 
-from contextlib import contextmanager
+from artifact import ArtifactWriter
+from contextlib import closing, contextmanager
 from fabric import colors
 from fabric import operations as ops, context_managers as ctx
-from fabric.api import env, task
+from fabric.api import env, execute, parallel, task
 from fabric.contrib import files
 from fabric.contrib.console import confirm
 from fabric.decorators import runs_once
 from fabric.operations import open_shell
+from bisect import bisect_right
 from functools import wraps
 from tempfile import mkdtemp
 from shutil import rmtree
 import glob
+import base64
 import hashlib
 import hmac
+import itertools
+import json
+import math
 import os
 import re
 import sys
+import time
 import traceback
 
 try:
@@ -51,6 +61,7 @@ except ImportError:
         return join(*rel_list)
 
 SIG_FILE = '.builds/project-deps.sig'
+ARTIFACT_FILE = '.builds/%s.artifact'
 DEPS_FILE = '.builds/project-deps.tar.bz2'
 
 @contextmanager
@@ -107,6 +118,112 @@ def silentrun(command, use_sudo=False, **kwargs):
     with ctx.settings(ctx.hide('aborts', 'warnings'), warn_only=True):
         return (ops.sudo if use_sudo else ops.run)(command, kwargs)
 
+def percentile(values, pct):
+    "Nearest-rank percentile of an already sorted list."
+    if not values:
+        return 0
+    index = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+def print_table(headers, rows):
+    widths = [len(str(h)) for h in headers]
+    for row in rows:
+        widths = [max(w, len(str(cell))) for w, cell in zip(widths, row)]
+    print colors.yellow("  ".join(str(h).ljust(w) for h, w in zip(headers, widths)))
+    for row in rows:
+        print "  ".join(str(cell).ljust(w) for cell, w in zip(row, widths))
+
+class DeployTimer(object):
+    """
+    Wall time, remote round trips and bytes transferred per deploy phase. Only
+    records between start() and stop() (see record_deploy).
+    """
+    def __init__(self):
+        self.phases = None
+        self.stack = []
+
+    def start(self):
+        self.phases = {}
+        self.stack = []
+
+    def stop(self):
+        phases, self.phases = self.phases, None
+        return phases
+
+    def stats(self, name):
+        return self.phases.setdefault(name, dict(calls=0, wall=0.0, round_trips=0, bytes_up=0, bytes_down=0))
+
+    @contextmanager
+    def phase(self, name):
+        if self.phases is None:
+            yield
+            return
+        self.stack.append(name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            stats = self.stats(name)
+            stats['calls'] += 1
+            stats['wall'] += time.time() - start
+
+    def count(self, bytes_up=0, bytes_down=0):
+        if self.phases is None:
+            return
+        stats = self.stats(self.stack[-1] if self.stack else 'other')
+        stats['round_trips'] += 1
+        stats['bytes_up'] += bytes_up
+        stats['bytes_down'] += bytes_down
+
+deploy_timer = DeployTimer()
+
+def timed(phase):
+    "Record the decorated function as `phase` (a name or a callable that gets the arguments)."
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with deploy_timer.phase(phase(*args, **kwargs) if callable(phase) else phase):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def transfer_size(local_path):
+    if hasattr(local_path, 'read'):
+        try:
+            return os.fstat(local_path.fileno()).st_size
+        except (AttributeError, IOError, OSError):
+            return len(getattr(local_path, 'getvalue', lambda: '')())
+    return sum(os.path.getsize(path) for path in glob.glob(os.path.expanduser(local_path or ''))
+               if os.path.isfile(path))
+
+class InstrumentedOperations(object):
+    "Proxy for fabric.operations that counts the remote calls for deploy_timer."
+    def __init__(self, operations):
+        self.operations = operations
+
+    def __getattr__(self, name):
+        return getattr(self.operations, name)
+
+    def run(self, *args, **kwargs):
+        deploy_timer.count()
+        return self.operations.run(*args, **kwargs)
+
+    def sudo(self, *args, **kwargs):
+        deploy_timer.count()
+        return self.operations.sudo(*args, **kwargs)
+
+    def put(self, local_path=None, *args, **kwargs):
+        deploy_timer.count(bytes_up=transfer_size(local_path))
+        return self.operations.put(local_path, *args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        result = self.operations.get(*args, **kwargs)
+        deploy_timer.count(bytes_down=sum(os.path.getsize(path) for path in result if os.path.isfile(path)))
+        return result
+
+ops = InstrumentedOperations(ops)
+
 class cached_property(object):
     def __init__(self, function, name=None):
         self.function = function
@@ -186,6 +303,7 @@ prj = Project()
 
 @runs_once
 @task
+@timed('build')
 def build(args=''):
     """
     Make a build of the current revision in .build directory.
@@ -222,34 +340,37 @@ def build(args=''):
                 fh.write(prj.requirements_hash)
 
 
-        # Create the project package
-        if getattr(settings, 'build_ignore_file_patterns', None):
-            # the cat is a work around buffering issue in tarfile (pipe would get
-            # closed before tarfile flushes it's contents at Tarfile.__del__)
-            exclude_pipe = (
-                '| python -u -c "import sys; sys.stdout.write(sys.stdin.read())" | tar --wildcards --delete ' +
-                ' '.join(
-                    [os.path.join(prj.build_name, pattern) for pattern in settings.build_ignore_file_patterns]))
-        else:
-            exclude_pipe = ''
+        # Create the artifact: the project, the wheels and virtualenv, each
+        # file compressed separately (see artifact.py)
+        import subprocess
+        import tarfile
+        from fnmatch import fnmatch
+
+        ignored = getattr(settings, 'build_ignore_file_patterns', None) or ()
+
+        def exclude(name):
+            return any(fnmatch(name, pattern) or fnmatch(name, pattern + '/*')
+                       for pattern in ignored)
 
         if prj.is_hg:
-            local('hg archive --type=tar --prefix=%s - %s | bzip2 -cz9 > .builds/project.tar.bz2' % (
-                prj.build_name,
-                exclude_pipe
-            ))
+            archive_command = ['hg', 'archive', '--type=tar', '--prefix=archive', '-r', prj.tag, '-']
         elif prj.is_git:
-            local('git archive --format=tar --prefix=%s/ %s %s | bzip2 -cz9 > .builds/project.tar.bz2' % (
-                prj.build_name,
-                prj.tag,
-                exclude_pipe
-            ))
+            archive_command = ['git', 'archive', '--format=tar', '--prefix=archive/', prj.tag]
         else:
             raise RuntimeError, "Unknown revision control system. Cannot build."
 
-        with ctx.lcd('.builds'):
-            local('tar -cf %s.tar project.tar.bz2 project-deps.tar.bz2 ../dist/virtualenv*.tar.gz' % prj.build_name)
-            local('rm -f project.tar.bz2')
+        print colors.blue("Creating %s ..." % ARTIFACT_FILE % prj.build_name)
+        with ArtifactWriter(ARTIFACT_FILE % prj.build_name) as artifact:
+            process = subprocess.Popen(archive_command, stdout=subprocess.PIPE)
+            with closing(tarfile.open(fileobj=process.stdout, mode='r|')) as archive:
+                artifact.add_tar(archive, prefix=prj.build_name + '/', strip=1, exclude=exclude)
+            if process.wait():
+                raise RuntimeError("%s failed." % ' '.join(archive_command))
+            with closing(tarfile.open(DEPS_FILE, 'r:bz2')) as archive:
+                artifact.add_tar(archive, prefix='wheelhouse/')
+            for path in glob.glob('dist/virtualenv*.tar.gz'):
+                with closing(tarfile.open(path, 'r:gz')) as archive:
+                    artifact.add_tar(archive, prefix='virtualenv/', strip=1)
 
         # Remove pip's temp dirs
         local('rm -rf build-bundle* src-bundle*')
@@ -273,6 +394,7 @@ def build(args=''):
 
 @task
 @require_role
+@timed('upload')
 def upload(what=None):
     """
     Upload the built project package to the remote server.
@@ -282,19 +404,23 @@ def upload(what=None):
     else:
         with ctx.lcd(settings.root_path):
             ops.run('mkdir -p builds')
-            # Upload the current package
-            fname = "builds/%s.tar" % prj.build_name
+            # Upload the current package and the tool that reads it
+            fname = "builds/%s.artifact" % prj.build_name
             ops.put("." + fname, fname)
+            ops.put("artifact.py", "builds/artifact.py")
+            ops.run("python builds/artifact.py verify %s" % fname)
 
 
 @task
 @require_role
+@timed('bundlestrap')
 def bundlestrap():
     """
     Bootstrap the uploaded project package on the remote server.
     """
     deployment_dir = '~/%s/%s' % (settings.deployment_dir, env.role)
-    ops.run('mkdir -p ~/run ~/media-%s ~/logs %s' % (env.role, deployment_dir))
+    ops.run('mkdir -p ~/run ~/media-%s ~/protected-media-%s ~/logs %s' % (
+        env.role, env.role, deployment_dir))
     # temporarily disable .pydistutils.cfg, see https://github.com/pypa/virtualenv/issues/88
     pydistutils = files.exists('.pydistutils.cfg')
     if pydistutils:
@@ -306,29 +432,23 @@ def bundlestrap():
         if silentrun("dpkg -s %s > /dev/null" % pkg).failed:
             ops.sudo("sudo apt-get install -qq " + pkg)
 
+    artifact = 'python ~/builds/artifact.py extract ~/builds/%s.artifact' % prj.build_name
     with ctx.cd(deployment_dir):
         ops.run('rm -rf %s' % prj.build_name)
-        ops.run('tar -xvf ~/builds/%s.tar' % prj.build_name)
-        ops.run('tar -xjf project.tar.bz2')
-        with ctx.cd('dist'):
-            ops.run('tar -xzf virtualenv*.tar.gz --strip 1')
-            ops.run('python virtualenv.py ../%s/.ve --python=%s --system-site-packages' % (
-                prj.build_name, settings.py_version
-            ))
+        ops.run('%s . %s' % (artifact, prj.build_name))
         tempdir = ops.run("mktemp -d /tmp/wheelhouse-%s-XXXXX" % settings.project_name)
         try:
-            with ctx.cd(tempdir):
-                ops.run('tar -xjvf %s/project-deps.tar.bz2' % (
-                    deployment_dir,
-                ))
+            ops.run('%s %s wheelhouse virtualenv' % (artifact, tempdir))
+            ops.run('python %s/virtualenv/virtualenv.py %s/.ve --python=%s --system-site-packages' % (
+                tempdir, prj.build_name, settings.py_version
+            ))
             ops.run(
                 '%s/.ve/bin/pip install --ignore-installed --upgrade --no-index '
-                '--no-deps %s/*' % (prj.build_name, tempdir)
+                '--no-deps %s/wheelhouse/*' % (prj.build_name, tempdir)
             )
         finally:
             ops.run("rm -rf %r" % tempdir)
-        ops.run('rm -rf %s/.ve/build dist' % prj.build_name)
-        ops.run('rm -f project-deps.tar.bz2 project.tar.bz2')
+        ops.run('rm -rf %s/.ve/build' % prj.build_name)
 
     with ctx.cd("%s/%s" % (deployment_dir, prj.build_name)):
         ops.run('.ve/bin/python setup.py develop')
@@ -336,14 +456,106 @@ def bundlestrap():
     if pydistutils:
         ops.run("mv ~/.pydistutils.cfg.disabled ~/.pydistutils.cfg")
 
+# supervisord templates only installed when the env.roleconfig key is set
+SUPERVISORD_OPTIONAL_PROGRAMS = {
+    # the jobs are in the crontab otherwise (see config_cron)
+    'scheduler': 'SCHEDULER',
+    # the settings_<role> modules connect through it if their PGBOUNCER is set
+    'pgbouncer': 'PGBOUNCER',
+}
+
+# supervisord programs that are only restarted when their files change (`supervisorctl
+# update` restarts them if their program section changes)
+SUPERVISORD_RESTART_ON_CHANGE = ('pgbouncer',)
+
+# supervisord templates that get a program per release with WARM_STANDBY
+WARM_STANDBY_PROGRAMS = ('app',)
+
+def warm_standby():
+    return env.roleconfig.get(env.role, {}).get('WARM_STANDBY', False)
+
+def release_program(build_name, config_name='app'):
+    "Name of the supervisord program that runs `build_name` (with WARM_STANDBY)."
+    return '%s-%s-%s-%s' % (settings.project_name, env.role, config_name,
+                            build_name[len(settings.project_name) + 1:])
+
+def switch_link(name, target):
+    "Atomically (re)point the `name` symlink in the current remote directory."
+    ops.run('ln -sfn %s %s.tmp && mv -Tf %s.tmp %s' % (target, name, name, name))
+
+def release_links():
+    "Returns the builds the current and previous links point to ('' if missing)."
+    with ctx.cd('~/%s/%s' % (settings.deployment_dir, env.role)):
+        return [silentrun('readlink %s' % link).strip() if silentrun('test -L %s' % link).succeeded else ''
+                for link in ('current', 'previous')]
+
+def switch_socket(build_name):
+    "Point the web server (the live socket link) to the app server of `build_name`."
+    with ctx.cd('~/run'):
+        switch_link('%s-%s.sock' % (settings.project_name, env.role),
+                    release_program(build_name) + '.sock')
+
 @require_role
 @task
 def rollover_project_link():
+    current, _ = release_links()
     with ctx.cd('~/%s/%s' % (settings.deployment_dir, env.role)):
-        ops.run('rm -f current && ln -s %s current' % prj.build_name)
+        if current and current != prj.build_name:
+            switch_link('previous', current)
+        switch_link('current', prj.build_name)
+    if warm_standby():
+        switch_socket(prj.build_name)
 
 @task
 @require_role
+def rollback():
+    """
+    Switch back to the previous release. Needs WARM_STANDBY (nginx + uwsgi): the previous app server is still running so only the links are switched.
+    """
+    if not warm_standby():
+        raise RuntimeError("Instant rollback needs WARM_STANDBY in env.roleconfig[%r]." % env.role)
+    current, previous = release_links()
+    if not previous:
+        raise RuntimeError("There's no previous release to roll back to.")
+    program = release_program(previous)
+    states = dict((process['name'], process['state'])
+                  for process in parse_supervisor_status(silentrun("supervisorctl status", use_sudo=True)))
+    if states.get(program) != 'RUNNING':
+        raise RuntimeError("The standby app server %s is %s." % (program, states.get(program, 'not installed')))
+    switch_socket(previous)
+    with ctx.cd('~/%s/%s' % (settings.deployment_dir, env.role)):
+        switch_link('current', previous)
+        switch_link('previous', current)
+    print colors.green("Rolled back from %s to %s (run rollback again to undo)." % (current, previous))
+
+@task
+@require_role
+def cleanup_standby():
+    """
+    Stop and remove the app servers of the releases older than the previous one (WARM_STANDBY).
+    """
+    if not warm_standby():
+        return
+    keep = set(release_program(build, name) for build in release_links() if build
+               for name in WARM_STANDBY_PROGRAMS)
+    with ctx.cd('~/supervisord/conf.d'):
+        programs = [
+            name[:-len('.conf')]
+            for config_name in WARM_STANDBY_PROGRAMS
+            for name in silentrun('ls -1 %s-%s-%s-*.conf' % (settings.project_name, env.role, config_name)).split()
+            if name.endswith('.conf')
+        ]
+        stale = [program for program in programs if program not in keep]
+        for program in stale:
+            ops.sudo("supervisorctl stop %s" % program)
+            ops.run("rm -f %s.*" % program)
+    if stale:
+        ops.sudo("supervisorctl reread")
+        ops.sudo("supervisorctl update")
+
+@task
+@require_role
+@timed(lambda args='', *rest, **kwargs: 'fab %s' % args)
 def fab(args='', role=None, version=None):
     "Run a remote fab command in the currently installed project's root."
     with ctx.cd("~/%s/%s/%s" % (settings.deployment_dir, env.role, version or 'current')):
@@ -371,10 +583,164 @@ def clean():
     with ctx.lcd(settings.root_path):
         local("rm -rf .ve .builds", quiet=True)
 
+BOOTSTRAP_STATE_FILE = '.ve/bootstrap-state.json'
+
+def file_hash(*paths):
+    digest = hashlib.sha1()
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, 'rb') as fh:
+                digest.update(fh.read())
+    return digest.hexdigest()
+
+def dist_key(name):
+    "Normalized distribution name (wheel filenames use _ instead of -)."
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+def wheelhouse_contents(path=DEPS_FILE):
+    "Maps the distribution names from the wheelhouse archive to (version, member name)."
+    import tarfile
+    wheels = {}
+    with closing(tarfile.open(path, 'r:bz2')) as archive:
+        for member in archive.getmembers():
+            name = os.path.basename(member.name)
+            if member.isfile() and name.endswith('.whl'):
+                dist_name, dist_version = name.split('-')[:2]
+                wheels[dist_key(dist_name)] = (dist_version, member.name)
+    return wheels
+
+def wheel_top_levels(path):
+    "The top level names (packages, modules, namespace package dirs) a wheel installs."
+    import zipfile
+    with closing(zipfile.ZipFile(path)) as archive:
+        return set(
+            name.split('/', 1)[0] for name in archive.namelist()
+            if not re.match(r'[^/]+\.(dist-info|data)/', name)
+        )
+
+def independent_groups(paths):
+    """
+    Groups the wheels that install in the same top level directories (eg:
+    namespace packages) together. Returns a list of lists of paths.
+    """
+    groups = []
+    for path in paths:
+        names, members = wheel_top_levels(path), [path]
+        for group in groups[:]:
+            if group[0] & names:
+                groups.remove(group)
+                names |= group[0]
+                members = group[1] + members
+        groups.append((names, members))
+    return [members for _, members in groups]
+
+def installed_distributions():
+    "Maps the distribution names installed in .ve (not the system ones) to versions."
+    installed = {}
+    for line in local('.ve/bin/pip freeze -l', capture=True).splitlines():
+        if '==' in line:
+            dist_name, dist_version = line.strip().split('==', 1)
+            installed[dist_key(dist_name)] = dist_version
+    return installed
+
+def install_requirements_devel():
+    local(
+        ".ve/bin/pip install --download-cache=.pip-cache"
+        " --source=.ve-src/ %s --timeout=1" % ' '.join(
+            "-r " + i for i in glob.glob("REQUIREMENTS.devel")
+        )
+    )
+
+def incremental_bootstrap():
+    """
+    Update the existing .ve: install the wheels that changed or are missing
+    (in parallel), uninstall the ones that were removed from the wheelhouse and
+    only run pip for REQUIREMENTS.devel or setup.py develop if they changed.
+    """
+    import subprocess
+    import tarfile
+    from multiprocessing import cpu_count
+    from multiprocessing.pool import ThreadPool
+
+    state = {}
+    if os.path.exists(BOOTSTRAP_STATE_FILE):
+        with open(BOOTSTRAP_STATE_FILE) as fh:
+            state = json.load(fh)
+    wheels = wheelhouse_contents()
+    installed = installed_distributions()
+
+    outdated = [member for key, (dist_version, member) in wheels.items()
+                if installed.get(key) != dist_version]
+    removed = [key for key in state.get('wheels', ()) if key not in wheels and key in installed]
+    print colors.blue("Incremental bootstrap: %s wheels to install, %s to remove, %s up to date." % (
+        len(outdated), len(removed), len(wheels) - len(outdated)))
+
+    if removed:
+        local('.ve/bin/pip uninstall -y %s' % ' '.join(removed))
+    if outdated:
+        tempdir = mkdtemp('-wheelhouse-%s' % settings.project_name)
+        try:
+            with closing(tarfile.open(DEPS_FILE, 'r:bz2')) as archive:
+                archive.extractall(tempdir, [archive.getmember(member) for member in outdated])
+
+            # wheels that share directories are installed by the same pip, one after
+            # the other, and every pip gets its own build directory (pip 1.x removes
+            # the default .ve/build when it's done)
+            groups = list(enumerate(independent_groups(
+                [os.path.join(tempdir, member) for member in outdated]
+            )))
+
+            def install_wheels(group):
+                number, paths = group
+                process = subprocess.Popen(
+                    ['.ve/bin/pip', 'install', '--upgrade', '--no-index', '--no-deps',
+                     '--build=%s' % os.path.join(tempdir, 'build-%s' % number)] + paths,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+                )
+                members = ', '.join(os.path.relpath(path, tempdir) for path in paths)
+                return members, process.communicate()[0], process.returncode
+
+            pool = ThreadPool(min(cpu_count(), len(groups)))
+            try:
+                failed = []
+                for members, output, code in pool.imap_unordered(install_wheels, groups):
+                    if code:
+                        print colors.red("Failed to install %s:" % members)
+                        print output
+                        failed.append(members)
+                    else:
+                        print colors.green("Installed %s" % members)
+            finally:
+                pool.close()
+            if failed:
+                raise RuntimeError("Failed to install: %s" % ', '.join(failed))
+        finally:
+            rmtree(tempdir)
+
+    devel_hash = file_hash(*glob.glob("REQUIREMENTS.devel"))
+    if state.get('devel') != devel_hash:
+        install_requirements_devel()
+    else:
+        print colors.blue("REQUIREMENTS.devel unchanged.")
+    setup_hash = file_hash('setup.py', 'setup.cfg')
+    if state.get('setup') != setup_hash or not glob.glob('.ve/lib/*/site-packages/*.egg-link'):
+        local(".ve/bin/python setup.py develop")
+    else:
+        print colors.blue("Project metadata unchanged, skipping setup.py develop.")
+    save_bootstrap_state(wheels, devel_hash, setup_hash)
+
+def save_bootstrap_state(wheels, devel_hash, setup_hash):
+    with open(BOOTSTRAP_STATE_FILE, 'w') as fh:
+        json.dump(dict(
+            wheels=dict((key, version) for key, (version, _) in wheels.items()),
+            devel=devel_hash,
+            setup=setup_hash,
+        ), fh, indent=2)
+
 @task
 def bootstrap(args=''):
     """
-    Setup a local working environment. Run bootstrap:clean to remove depependency caches.
+    Setup a local working environment. Only installs the changes if there's a .ve already. Run bootstrap:full to recreate the .ve or bootstrap:clean to also remove depependency caches.
     """
     with cwd(settings.root_path):
         deb_packages = [pkg.strip() for pkg in file("DEB-REQUIREMENTS")
@@ -387,6 +753,9 @@ def bootstrap(args=''):
                 local("sudo apt-get install `cat DEB-REQUIREMENTS | grep -v ^#`")
 
         build(args)
+        if args not in ('clean', 'full') and os.path.exists('.ve/bin/python'):
+            incremental_bootstrap()
+            return
         i = 0
         if os.path.exists('.ve'):
             for i in range(1, 11):
@@ -415,14 +784,14 @@ def bootstrap(args=''):
             finally:
                 rmtree(tempdir)
 
-            local(
-                ".ve/bin/pip install --download-cache=.pip-cache"
-                " --source=.ve-src/ %s --timeout=1" % ' '.join(
-                    "-r " + i for i in glob.glob("REQUIREMENTS.devel")
-                )
-            )
+            install_requirements_devel()
             # install project as a development package (inplace)
             local(".ve/bin/python setup.py develop")
+            save_bootstrap_state(
+                wheelhouse_contents(),
+                file_hash(*glob.glob("REQUIREMENTS.devel")),
+                file_hash('setup.py', 'setup.cfg'),
+            )
             local("rm -rf .ve-backup")
         except:
             if i:
@@ -446,13 +815,14 @@ def supports_symlink(dest='/tmp/symlink-test'):
             pass
 
 @task
-def python(args):
-    local(
+def python(args, capture=False):
+    return local(
         "DJANGO_SETTINGS_MODULE=%(project_name)s.settings_%(environment)s "
         "FLAVOR=%(environment)s %(root_path)s/.ve/bin/python %(args)s" % dict(
             settings,
             args=args
-        )
+        ),
+        capture=capture
     )
 
 @task
@@ -476,6 +846,94 @@ def django_startproject():
 def manage(args=''):
     python("%s/src/manage.py %s" % (settings.root_path, args))
 
+def schema_fingerprint():
+    """
+    Hash of everything that can change the database schema: the models,
+    migrations and settings from src, the REQUIREMENTS and the environment.
+    """
+    digest = hashlib.sha1(settings.environment)
+    with cwd(settings.root_path):
+        paths = ['REQUIREMENTS']
+        for dirpath, dirnames, filenames in os.walk('src'):
+            dirnames.sort()
+            parts = dirpath.split(os.sep)
+            for name in sorted(filenames):
+                if name.endswith('.py') and (
+                    'migrations' in parts or 'models' in parts or
+                    name == 'models.py' or name.startswith('settings')
+                ):
+                    paths.append(os.path.join(dirpath, name))
+        for path in paths:
+            digest.update(path)
+            digest.update(file_hash(path))
+    return digest.hexdigest()
+
+# Prints what identifies the databases (a recreated database gets a new
+# identity, a missing one has None in it) as JSON on the last line.
+DATABASE_IDENTITY_SCRIPT = '''
+import json, os
+from django.conf import settings
+from django.db import connections
+identity = {}
+for alias, database in sorted(settings.DATABASES.items()):
+    engine, name = database.get('ENGINE') or '', database.get('NAME') or ''
+    item = [engine, name, database.get('HOST'), database.get('PORT')]
+    if 'sqlite' in engine:
+        item.append(os.stat(name).st_ino if name != ':memory:' and os.path.exists(name) else None)
+    elif 'postgresql' in engine:
+        try:
+            cursor = connections[alias].cursor()
+            cursor.execute("SELECT oid FROM pg_database WHERE datname = current_database()")
+            item.append(cursor.fetchone()[0])
+        except Exception:
+            item.append(None)
+    identity[alias] = item
+print(json.dumps(identity))
+'''
+
+def database_identity():
+    "Identity of the databases of the current environment (see DATABASE_IDENTITY_SCRIPT)."
+    with ctx.settings(ctx.hide('running')):
+        output = python('-c "import base64; exec(base64.b64decode(\'%s\'))"' % base64.b64encode(
+            DATABASE_IDENTITY_SCRIPT), capture=True)
+    return json.loads(output.splitlines()[-1])
+
+def schema_fingerprint_path():
+    "Local builds keep it in db/, deployed builds share it (in the role's directory)."
+    if settings.environment == 'local':
+        return os.path.join(settings.root_path, 'db', 'schema-local.fingerprint')
+    return os.path.join(os.path.dirname(settings.root_path), 'schema.fingerprint')
+
+def forget_schema_fingerprint():
+    if os.path.exists(schema_fingerprint_path()):
+        os.unlink(schema_fingerprint_path())
+
+@task
+def migrate(force=False, verbosity=1):
+    """
+    Run syncdb --migrate only if the models or migrations changed since the last run (on the same databases). Eg: fab migrate, fab migrate:force=1
+    """
+    path = schema_fingerprint_path()
+    fingerprint = schema_fingerprint()
+    identity = database_identity()
+    missing = [alias for alias, item in identity.items() if None in item[4:]]
+    state = {}
+    if os.path.exists(path):
+        with open(path) as fh:
+            state = json.load(fh)
+    if not force and not missing and state.get('fingerprint') == fingerprint and \
+            state.get('databases') == identity:
+        print colors.green("Schema unchanged, skipped syncdb --migrate (saved ~%.1fs)." %
+                           state.get('duration', 0))
+        return
+    started = time.time()
+    manage("syncdb --verbosity=%s --migrate --noinput" % verbosity)
+    duration = time.time() - started
+    with open(path, 'w') as fh:
+        # missing databases were just created
+        json.dump(dict(fingerprint=fingerprint, databases=database_identity() if missing else identity,
+                       duration=duration), fh)
+
 @task
 def cleanup_pyc():
     """
@@ -533,24 +991,110 @@ def prune_builds(keep=3):
     if keep:
         with ctx.cd('~/%s/%s' % (settings.deployment_dir, env.role)):
             versions = [i for i in silentrun('ls -1t').split() if i.startswith(settings.project_name)]
+            in_use = release_links()
             for version in versions[keep:]:
+                if version in in_use:
+                    continue
                 ops.run('rm -rf %s' % version)
-                ops.run('rm -f ~/builds/%s.tar' % version)
+                ops.run('rm -f ~/builds/%s.artifact' % version)
+
+INDEX_URL = 'https://pypi.org/pypi/%s/json'
+INDEX_CACHE_DIR = '.pip-cache/index'
+DIST_FILE_RE = re.compile(r'^(?P<name>.+?)-(?P<version>\d[^-]*?)(?:-[^-]+-[^-]+-[^-]+\.whl|\.tar\.gz|\.tar\.bz2|\.zip|\.tgz|-py[\d.]+\.egg)$', re.I)
+# a pre-release segment after a dotted release (1.0a1, 2.0rc1, 1.0.dev3, 1.0.post1.dev2) but
+# not the pytz style final releases (2013b)
+PRERELEASE_RE = re.compile(
+    r'^v?\d+(?:\.\d+)+(?:[-_.]?post\d*)?[-_.]?(?:a|b|c|rc|alpha|beta|pre|preview|dev)\d*(?:[-_.+]|$)', re.I
+)
+
+def read_requirements(path='REQUIREMENTS'):
+    "Returns (name, pinned version or None) for the index requirements in the file."
+    requirements = []
+    for line in open(path):
+        line = line.strip()
+        if not line or line.startswith(('#', '-')) or '/' in line:
+            continue
+        name = re.split(r'[<>=!~;\[\s]', line, 1)[0]
+        pinned = line.split('==', 1)[1].split(';')[0].strip() if '==' in line else None
+        requirements.append((name, pinned))
+    return requirements
+
+def index_versions(name, index=None, ttl=3600):
+    """
+    Returns the versions of `name` from `index`: an url template for a PyPI
+    style JSON api (the default), a local mirror directory (with the sdists or
+    wheels in it or in a <name> subdirectory) or a directory with <name>.json
+    files in the PyPI JSON format (a file based stand-in for the index). The
+    responses from urls are cached in .pip-cache/index for `ttl` seconds.
+    """
+    import urllib2
+    index = index or INDEX_URL
+    if os.path.isdir(index):
+        json_path = os.path.join(index, '%s.json' % name)
+        if os.path.exists(json_path):
+            with open(json_path) as fh:
+                return json.load(fh)['releases'].keys()
+        versions = set()
+        for directory in (index, os.path.join(index, name), os.path.join(index, name.lower())):
+            if not os.path.isdir(directory):
+                continue
+            for filename in os.listdir(directory):
+                match = DIST_FILE_RE.match(filename)
+                if match and dist_key(match.group('name')) == dist_key(name):
+                    versions.add(match.group('version'))
+        return list(versions)
+
+    cache_path = os.path.join(settings.root_path, INDEX_CACHE_DIR, '%s.json' % dist_key(name))
+    if os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < ttl:
+        with open(cache_path) as fh:
+            return json.load(fh)
+    response = urllib2.urlopen(index % name, timeout=30)
+    versions = json.load(response)['releases'].keys()
+    with open(cache_path, 'w') as fh:
+        json.dump(versions, fh)
+    return versions
 
 @task
-def check_dependency_updates():
+def check_dependency_updates(index=None, ttl=3600, workers=8):
     """
-    Check for dependency updates in the local development environment.
+    Check for dependency updates (queries the index concurrently, responses are cached for `ttl` seconds). Eg: fab check_dependency_updates; fab check_dependency_updates:index=/path/to/mirror
     """
+    from multiprocessing.pool import ThreadPool
+    from pkg_resources import parse_version
+
     with cwd(settings.root_path):
-        local('.ve/bin/pip install yolk')
-        reqs = [re.split('[<>=]', line)[0] for line in [
-            line.strip() for line in open('REQUIREMENTS')
-        ] if not line.startswith('#') and '/' not in line
-        ]
+        local('mkdir -p %s' % INDEX_CACHE_DIR, quiet=True)
+        requirements = read_requirements()
+        wheels = wheelhouse_contents() if os.path.exists(DEPS_FILE) else {}
+
+    def latest_version(requirement):
+        name = requirement[0]
+        try:
+            versions = [v for v in index_versions(name, index, int(ttl))
+                        if not PRERELEASE_RE.match(v)]
+        except Exception, exc:
+            return requirement, 'error: %s' % exc
+        return requirement, max(versions, key=parse_version) if versions else '?'
 
-        for req in reqs:
-            local('.ve/bin/yolk -U ' + req)
+    pool = ThreadPool(int(workers))
+    try:
+        results = pool.map(latest_version, requirements)
+    finally:
+        pool.close()
+
+    rows = []
+    for (name, current), latest in results:
+        wheel_version = wheels.get(dist_key(name), ('-',))[0]
+        outdated = current and not latest.startswith(('?', 'error')) and \
+            parse_version(latest) > parse_version(current)
+        rows.append([
+            name,
+            current or '-',
+            latest,
+            'UPDATE' if outdated else '',
+            'yes' if wheel_version == current else wheel_version,
+        ])
+    print_table(('package', 'current', 'latest', '', 'cached wheel'), rows)
 
 @task
 def update_dependency(name=None):
@@ -572,10 +1116,15 @@ def install_config_templates(template_pattern,
                              rollback_action,
                              rollover_action,
                              install_action,
+                             name,
                              glob_pattern="*", **extra_template_vars):
+    """
+    Install the templates matching `template_pattern` and return the rollover
+    action. `name` (eg: "apache") is used in the messages and the deploy
+    timings.
+    """
     if local('python -c "import jinja2"', quiet=True).failed:
         local('sudo pip install Jinja2')
-    caller_name = sys._getframe(4).f_code.co_name
 
     with ctx.cd("~/"), ctx.lcd(settings.root_path), cwd(settings.root_path):
         home_path = ops.run('pwd').strip()
@@ -587,39 +1136,44 @@ def install_config_templates(template_pattern,
                                    settings.deployment_dir,
                                    env.role,
                                    prj.build_name),
+            'CURRENTDIR': os.path.join(home_path,
+                                       settings.deployment_dir,
+                                       env.role,
+                                       'current'),
             'USERDIR': home_path,
         }
         template_vars.update(env.roleconfig[env.role])
         template_vars.update(extra_template_vars)
 
-        print colors.blue("Running backup action for %s ..." % caller_name)
-        backup_action(**template_vars)
-
-        config_files = []
-        for config_file in glob.glob(
-            template_pattern % glob_pattern
-                if glob_pattern is not None
-                else template_pattern):
-            print colors.green(
-                "Installing %s for %s ..." % (config_file, caller_name)
-            )
-            config_files.append(install_action(config_file, **template_vars))
+        with deploy_timer.phase('install_templates_' + name):
+            print colors.blue("Running backup action for %s ..." % name)
+            backup_action(**template_vars)
+
+            config_files = []
+            for config_file in glob.glob(
+                template_pattern % glob_pattern
+                    if glob_pattern is not None
+                    else template_pattern):
+                print colors.green(
+                    "Installing %s for %s ..." % (config_file, name)
+                )
+                config_files.append(install_action(config_file, **template_vars))
 
         def rollover():
             try:
                 print colors.yellow(
-                    "Running rollover action for %s ..." % caller_name
+                    "Running rollover action for %s ..." % name
                 )
                 rollover_action(config_files, **template_vars)
             except:
                 traceback.print_exc()
                 print colors.red(
                     "Unexpected error. Running rollback action for %s ..." %
-                    caller_name
+                    name
                 )
                 rollback_action(**template_vars)
                 raise
-        rollover.__name__ = 'rollover_'+caller_name
+        rollover.__name__ = 'rollover_' + name
         rollover.rollback = lambda: rollback_action(**template_vars)
         return rollover
 
@@ -636,20 +1190,44 @@ def config_supervisord(glob_pattern="*", **kwargs):
         ops.run("mv %(USERDIR)s/supervisord/conf.d-backup %(USERDIR)s/supervisord/conf.d" % kwargs)
         rollover_action([], **kwargs) #XXX
 
+    # program name: if any of its files changed, for the SUPERVISORD_RESTART_ON_CHANGE programs
+    changed = {}
+
     def rollover_action(names, **kwargs):
+        names = [name for name in names if name and changed.get(name, True)]
         [ops.sudo("supervisorctl stop %s" % name) for name in names if name]
         ops.sudo("supervisorctl reread")
         ops.sudo("supervisorctl update")
         [ops.sudo("supervisorctl start %s" % name) for name in names if name]
-        ops.sudo("supervisorctl status") #TODO: check for BACKOFF and other error states !
+        failed = [
+            "%(name)s (%(state)s)" % process
+            for process in parse_supervisor_status(ops.sudo("supervisorctl status"))
+            if process['name'] in names and process['state'] in SUPERVISOR_FAILED_STATES
+        ]
+        if failed:
+            raise RuntimeError("Programs failed to start: %s" % ', '.join(failed))
 
     def install_action(config_file, **kwargs):
         kwargs['CONFIGNAME'], kwargs['CONFIGTYPE'] = os.path.splitext(os.path.basename(config_file))
-        kwargs['PROGRAMNAME'] = "%(PKGNAME)s-%(FLAVOR)s-%(CONFIGNAME)s" % kwargs
+        if kwargs.get('WARM_STANDBY') and kwargs['CONFIGNAME'] in WARM_STANDBY_PROGRAMS:
+            # a program per release, the previous one stays running as a warm standby
+            kwargs['PROGRAMNAME'] = release_program(prj.build_name, kwargs['CONFIGNAME'])
+        else:
+            kwargs['PROGRAMNAME'] = "%(PKGNAME)s-%(FLAVOR)s-%(CONFIGNAME)s" % kwargs
         conf_path = "%(USERDIR)s/supervisord/conf.d/%(PROGRAMNAME)s%(CONFIGTYPE)s" % kwargs
         kwargs['CONFIGABSOLUTENAME'] = os.path.splitext(conf_path)[0]
         ops.run("mkdir -p %(USERDIR)s/supervisord/conf.d" % kwargs)
+        if kwargs['CONFIGNAME'] in SUPERVISORD_OPTIONAL_PROGRAMS and \
+                not kwargs.get(SUPERVISORD_OPTIONAL_PROGRAMS[kwargs['CONFIGNAME']]):
+            # not enabled for the role, `supervisorctl update` removes it if it was installed
+            ops.run("rm -f %s" % conf_path)
+            return
+        checksum = "md5sum %s 2>/dev/null || true" % conf_path
+        if kwargs['CONFIGNAME'] in SUPERVISORD_RESTART_ON_CHANGE:
+            before = silentrun(checksum)
         files.upload_template(config_file, conf_path, kwargs, use_jinja=settings.use_jinja)
+        if kwargs['CONFIGNAME'] in SUPERVISORD_RESTART_ON_CHANGE:
+            changed[kwargs['PROGRAMNAME']] = changed.get(kwargs['PROGRAMNAME']) or silentrun(checksum) != before
         if kwargs['CONFIGTYPE'] == ".conf":
             return kwargs['PROGRAMNAME']
 
@@ -674,6 +1252,7 @@ def config_supervisord(glob_pattern="*", **kwargs):
         rollover_action,
         install_action,
         environment=environment,
+        name='supervisord',
         glob_pattern=glob_pattern,
         **kwargs
     )
@@ -712,6 +1291,9 @@ def config_apache(glob_pattern="*", **kwargs):
             )
             ops.sudo("a2enmod headers")
             ops.sudo("a2enmod wsgi")
+        if silentrun("dpkg -s libapache2-mod-xsendfile > /dev/null").failed:
+            ops.sudo("apt-get install -qq libapache2-mod-xsendfile")
+            ops.sudo("a2enmod xsendfile")
         if not files.contains(
             '/etc/apache2/apache2.conf',
             "Include %s/httpd/conf.d/*.conf" % home_path,
@@ -729,25 +1311,69 @@ def config_apache(glob_pattern="*", **kwargs):
         rollover_action,
         install_action,
         environment=environment,
+        name='apache',
         glob_pattern=glob_pattern,
         **kwargs
     )
 
+POSTGRESQL_CONF_DIR = '/etc/postgresql/9.1/main'
+
+def postgresql_tuning(memory, max_connections=100):
+    """
+    Memory settings (in MB) for a dedicated database host with `memory` MB of
+    RAM, roughly what pgtune recommends for web applications.
+    """
+    shared_buffers = min(memory // 4, 8192)
+    return {
+        'MEMORY': memory,
+        'MAX_CONNECTIONS': max_connections,
+        'SHARED_BUFFERS': shared_buffers,
+        'EFFECTIVE_CACHE_SIZE': memory * 3 // 4,
+        'MAINTENANCE_WORK_MEM': max(16, min(memory // 16, 1024)),
+        # a query can use work_mem several times (sorts, hashes)
+        'WORK_MEM': max(1, (memory - shared_buffers) // (max_connections * 3)),
+    }
+
 @task
 @require_role
 def setup_postgresql():
     """
-    Setup postgresql on the remote server.
+    Setup postgresql (memory settings tuned for the host) and install pgbouncer on the remote server.
     """
     if silentrun("dpkg -s postgresql-9.1 > /dev/null").failed:
         ops.sudo("apt-get install -qq postgresql-9.1")
-        files.append('local all all trust',
-                     '/etc/postgresql/9.1/main/pg_hba.conf', use_sudo=True)
+        files.append(POSTGRESQL_CONF_DIR + '/pg_hba.conf', 'local all all trust', use_sudo=True)
         ops.sudo("/etc/init.d/postgresql restart")
         with ctx.settings(warn_only=True):
             ops.sudo("sudo -u postgres createuser -R -S -d " + env.user)
+    # the supervisord pgbouncer program, the system service stays disabled
+    if silentrun("dpkg -s pgbouncer > /dev/null").failed:
+        ops.sudo("apt-get install -qq pgbouncer")
+
+    roleconfig = env.roleconfig.get(env.role, {})
+    memory = int(silentrun("awk '/^MemTotal:/ {print $2}' /proc/meminfo")) // 1024
+    tuning = postgresql_tuning(memory, roleconfig.get('POSTGRESQL_MAX_CONNECTIONS', 100))
+    # 9.1 uses SysV shared memory and the default kernel.shmmax is only 32MB
+    shmmax = (tuning['SHARED_BUFFERS'] + 64 + tuning['MAX_CONNECTIONS'] // 4) * 1024 * 1024
+    if int(silentrun("sysctl -n kernel.shmmax")) < shmmax:
+        ops.sudo("printf 'kernel.shmmax = %s\\nkernel.shmall = %s\\n' > /etc/sysctl.d/30-postgresql-shm.conf" % (
+            shmmax, shmmax // int(silentrun("getconf PAGE_SIZE"))))
+        ops.sudo("sysctl -p /etc/sysctl.d/30-postgresql-shm.conf")
+    tuning_path = POSTGRESQL_CONF_DIR + '/tuning.conf'
+    checksum = "md5sum %s 2>/dev/null || true" % tuning_path
+    before = silentrun(checksum)
+    files.upload_template(os.path.join(settings.root_path, 'dist/templates/postgresql/tuning.conf'),
+                          tuning_path, tuning,
+                          use_jinja=settings.use_jinja, use_sudo=True)
+    if not files.contains(POSTGRESQL_CONF_DIR + '/postgresql.conf', "include 'tuning.conf'"):
+        files.append(POSTGRESQL_CONF_DIR + '/postgresql.conf', "include 'tuning.conf'", use_sudo=True)
+    if silentrun(checksum) != before:
+        print colors.yellow("PostgreSQL tuned for %(MEMORY)sMB: shared_buffers=%(SHARED_BUFFERS)sMB "
+                            "effective_cache_size=%(EFFECTIVE_CACHE_SIZE)sMB work_mem=%(WORK_MEM)sMB" % tuning)
+        ops.sudo("/etc/init.d/postgresql restart")
+
     with ctx.settings(warn_only=True):
-        ops.run("createdb %s --encoding=UTF8 --locale=en_US.UTF-8" % env.roleconfig.get(env.role, {}).get('DATABASE_NAME', "%s_%s" % (settings.project_name, env.role)))
+        ops.run("createdb %s --encoding=UTF8 --locale=en_US.UTF-8" % roleconfig.get('DATABASE_NAME', "%s_%s" % (settings.project_name, env.role)))
     if silentrun("dpkg -s python-psycopg2 > /dev/null").failed:
         ops.sudo("apt-get install -qq python-psycopg2")
 
@@ -776,6 +1402,7 @@ def config_cron(**kwargs):
         rollover_action,
         install_action,
         environment=environment,
+        name='cron',
         glob_pattern=None,
         **kwargs
     )
@@ -839,20 +1466,926 @@ def config_nginx(glob_pattern="*", **kwargs):
         rollover_action,
         install_action,
         environment=environment,
+        name='nginx',
         glob_pattern=glob_pattern,
         **kwargs
     )
 
+MICROCACHE_DIR = '/var/cache/nginx/%s-%s'
+
+@task
+@require_role
+def purge_cache(prefix='/'):
+    """
+    Remove the nginx micro-cache (MICROCACHE) entries for the urls starting with `prefix`. Eg: fab -R prod purge_cache:/blog/
+    """
+    roleconfig = env.roleconfig.get(env.role, {})
+    if not roleconfig.get('MICROCACHE'):
+        raise RuntimeError("There's no MICROCACHE in env.roleconfig[%r]." % env.role)
+    if 'SERVER_NAME' not in roleconfig:
+        raise RuntimeError("There's no SERVER_NAME in env.roleconfig[%r]." % env.role)
+    cache_dir = MICROCACHE_DIR % (settings.project_name, env.role)
+    # the first lines of an entry have the key (uwsgi_cache_key is $host$request_uri), the
+    # whole pipeline runs as root (the cache is only readable by nginx's user)
+    with ctx.settings(ctx.hide('aborts', 'warnings'), warn_only=True):
+        purged = ops.sudo(
+            "test -d %s && grep -rlZaF 'KEY: %s%s' %s | xargs -0r rm -vf | wc -l" % (
+                cache_dir, roleconfig['SERVER_NAME'], prefix.replace("'", ""), cache_dir),
+            shell=True,
+        ).strip() or 0
+    print colors.green("Purged %s cached responses for %s%s" % (purged, roleconfig['SERVER_NAME'], prefix))
+
 def install(*actions):
     ran = []
 
     print colors.yellow('Running rollover actions:'), colors.magenta([a.__name__ for a in actions])
     for action in reversed(actions):
         try:
-            action()
+            with deploy_timer.phase(action.__name__):
+                action()
             ran.append(action)
         except:
             print colors.red('Rolling back: %s' % [a.__name__ for a in ran])
             for act in ran:
                 act.rollback()
             raise
+
+ACCESS_LOG_REQUEST = re.compile(
+    r'\S+ \S+ \S+ \[[^\]]*\] "(?P<method>[A-Z]+) (?P<uri>\S+)[^"]*" (?P<status>\d{3}) '
+)
+ACCESS_LOG_TIMING = re.compile(r' (rt|rtus|urt|ts)=(\S+)')
+ENDPOINT_ID = re.compile(r'/(?:\d+|[0-9a-f]{32}|[0-9a-f-]{36})(?=/|$)')
+
+def parse_access_log_line(line):
+    """
+    Parses a line from the nginx, apache or uwsgi access logs (see the log
+    formats in dist/templates). Returns a (timestamp, method, endpoint,
+    status, request_time, upstream_time) tuple or None if the line doesn't
+    have timing information.
+    """
+    match = ACCESS_LOG_REQUEST.search(line)
+    if not match:
+        return
+    fields = dict(ACCESS_LOG_TIMING.findall(line))
+    try:
+        timestamp = float(fields['ts'])
+        if 'rt' in fields:
+            request_time = float(fields['rt'])
+        else:
+            request_time = int(fields['rtus']) / 1000000.0
+    except (KeyError, ValueError):
+        return
+    upstream_time = None
+    if fields.get('urt', '-') != '-':
+        try:
+            upstream_time = sum(float(i) for i in fields['urt'].split(',') if i)
+        except ValueError:
+            pass
+    endpoint = ENDPOINT_ID.sub('/:id', match.group('uri').split('?', 1)[0])
+    return (timestamp, match.group('method'), endpoint, int(match.group('status')),
+            request_time, upstream_time)
+
+def read_access_log(path, host):
+    import gzip
+    with gzip.open(path) as fh:
+        for line in fh:
+            record = parse_access_log_line(line.rstrip('\n'))
+            if record:
+                yield (record[0], host) + record[1:]
+
+@parallel
+def fetch_role_log(kind='access', lines=0):
+    """
+    Compress a log of the current role on the remote host and download it.
+    Returns the local path of the compressed log.
+    """
+    name = '%s-%s.%s.log' % (settings.project_name, env.role, kind)
+    remote_path = '/tmp/%s.%s.gz' % (name, os.getpid())
+    ops.run('%s ~/logs/%s | gzip -c > %s' % (
+        'tail -n %s' % int(lines) if int(lines) else 'cat',
+        name,
+        remote_path
+    ))
+    local_path = os.path.join(settings.root_path, 'download', 'logs', env.host, name + '.gz')
+    try:
+        ops.get(remote_path, local_path)
+    finally:
+        ops.run('rm -f %s' % remote_path)
+    return local_path
+
+@task
+@runs_once
+@require_role
+def latency_report(kind='access', lines=0, top=25, format='table'):
+    """
+    Latency percentiles, throughput and error rates per endpoint and host from
+    the access logs of all the hosts in the role. Eg: fab -R prod latency_report:uwsgi,lines=100000
+    """
+    paths = execute(fetch_role_log, kind=kind, lines=lines, roles=[env.role])
+    stats = {'endpoint': {}, 'host': {}}
+    # the apache and uwsgi timestamps are when the request started but the lines are
+    # written when it ends, so the logs aren't sorted
+    first = last = None
+    for timestamp, host, method, endpoint, status, request_time, upstream_time in itertools.chain(
+        *[read_access_log(path, host) for host, path in paths.items()]
+    ):
+        first = timestamp if first is None else min(first, timestamp)
+        last = timestamp if last is None else max(last, timestamp)
+        for group, key in (('endpoint', '%s %s' % (method, endpoint)), ('host', host)):
+            entry = stats[group].setdefault(key, {'times': [], 'upstream': [], 'errors': 0})
+            entry['times'].append(request_time)
+            if upstream_time is not None:
+                entry['upstream'].append(upstream_time)
+            if status >= 500:
+                entry['errors'] += 1
+
+    span = max((last or 0) - (first or 0), 1)
+    report = {}
+    for group, entries in stats.items():
+        report[group] = rows = []
+        for key, entry in entries.items():
+            times = sorted(entry['times'])
+            upstream = sorted(entry['upstream'])
+            rows.append(dict(
+                name=key,
+                count=len(times),
+                rps=round(len(times) / span, 2),
+                p50=round(percentile(times, 50) * 1000, 1),
+                p95=round(percentile(times, 95) * 1000, 1),
+                p99=round(percentile(times, 99) * 1000, 1),
+                upstream_p95=round(percentile(upstream, 95) * 1000, 1),
+                error_rate=round(100.0 * entry['errors'] / len(times), 2),
+            ))
+        rows.sort(key=lambda row: -row['count'])
+
+    if format == 'json':
+        print json.dumps(report, indent=2)
+        return report
+    columns = ('count', 'rps', 'p50', 'p95', 'p99', 'upstream_p95', 'error_rate')
+    for group in ('endpoint', 'host'):
+        print
+        print_table(
+            (group, 'count', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'upstream p95 ms', '5xx %'),
+            [[row['name']] + [row[c] for c in columns] for row in report[group][:int(top)]]
+        )
+    return report
+
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+def read_loadtest_scenario(path):
+    """
+    Reads a scenario file with a "<weight> <path or url>" pair on each line.
+    """
+    scenario = []
+    for line in file(path):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        weight, url = line.split(None, 1)
+        scenario.append((int(weight), url))
+    if not scenario:
+        raise RuntimeError("Scenario %r has no urls." % path)
+    return scenario
+
+@contextmanager
+def wsgi_server(target):
+    """
+    Yields the base url of the `target`: a role, an url or "local" (runs the
+    dev server of the local build on a free port).
+    """
+    import socket
+    import subprocess
+    import urllib2
+    if target.startswith('http'):
+        yield target.rstrip('/')
+        return
+    elif target != 'local':
+        roleconfig = env.roleconfig.get(target)
+        if roleconfig is None:
+            raise RuntimeError("Unknown load test target %r (use local, a role or an url)." % target)
+        if 'SERVER_NAME' not in roleconfig:
+            raise RuntimeError("The %r role has no SERVER_NAME in env.roleconfig, "
+                               "set it or use an url as the target." % target)
+        yield 'https://%s%s' % (roleconfig['SERVER_NAME'],
+                                roleconfig.get('HTTPD_ALIAS', '').rstrip('/'))
+        return
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    process = subprocess.Popen(
+        [os.path.join(settings.root_path, '.ve', 'bin', 'python'),
+         os.path.join(settings.root_path, 'src', 'manage.py'),
+         'runserver', '--noreload', '127.0.0.1:%s' % port],
+        env=dict(os.environ,
+                 DJANGO_SETTINGS_MODULE='%(project_name)s.settings_%(environment)s' % settings,
+                 FLAVOR=settings.environment),
+    )
+    base_url = 'http://127.0.0.1:%s' % port
+    try:
+        for _ in range(100):
+            if process.poll() is not None:
+                raise RuntimeError("Dev server exited with code %s." % process.returncode)
+            try:
+                urllib2.urlopen(base_url, timeout=1)
+                break
+            except urllib2.HTTPError:
+                break
+            except Exception:
+                time.sleep(0.2)
+        yield base_url
+    finally:
+        if process.poll() is None:
+            process.terminate()
+            process.wait()
+
+def generate_load(base_url, scenario, concurrency, duration):
+    """
+    Request urls from the scenario (picked randomly by weight) from
+    `concurrency` threads for `duration` seconds. Returns a list of
+    (latency, status) tuples.
+    """
+    import bisect
+    import random
+    import threading
+    import urllib2
+
+    cumulative = []
+    total = 0
+    for weight, _ in scenario:
+        total += weight
+        cumulative.append(total)
+    deadline = time.time() + duration
+    results = []
+
+    def worker():
+        while time.time() < deadline:
+            url = scenario[bisect.bisect(cumulative, random.random() * total)][1]
+            if not url.startswith('http'):
+                url = base_url + url
+            start = time.time()
+            try:
+                status = urllib2.urlopen(url, timeout=30).getcode()
+            except urllib2.HTTPError, exc:
+                status = exc.code
+            except Exception:
+                status = 0
+            results.append((time.time() - start, status))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+@task
+@runs_once
+def loadtest(target='local', scenario='LOADTEST', concurrency=10, duration=30,
+             threshold=10, baseline=None):
+    """
+    Load test the local build (or a role or url) and compare with the previous baseline. Eg: fab loadtest; fab loadtest:qa,concurrency=50
+    """
+    concurrency, duration, threshold = int(concurrency), int(duration), float(threshold)
+    with cwd(settings.root_path):
+        scenario = read_loadtest_scenario(scenario)
+        local('mkdir -p .builds')
+
+    with wsgi_server(target) as base_url:
+        print colors.blue("Load testing %s with %s clients for %ss ..." % (
+            base_url, concurrency, duration))
+        started = time.time()
+        results = generate_load(base_url, scenario, concurrency, duration)
+        elapsed = time.time() - started
+
+    times = sorted(latency * 1000 for latency, _ in results)
+    errors = len([status for _, status in results if not 200 <= status < 400])
+    histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+    for latency in times:
+        histogram[bisect_right(LATENCY_BUCKETS, latency)] += 1
+    report = dict(
+        build=prj.build_name,
+        target=target,
+        concurrency=concurrency,
+        requests=len(times),
+        errors=errors,
+        rps=round(len(times) / elapsed, 2),
+        p50=round(percentile(times, 50), 1),
+        p90=round(percentile(times, 90), 1),
+        p95=round(percentile(times, 95), 1),
+        p99=round(percentile(times, 99), 1),
+        max=round(times[-1] if times else 0, 1),
+        histogram=histogram,
+    )
+
+    print_table(
+        ('requests', 'errors', 'req/s', 'p50 ms', 'p90 ms', 'p95 ms', 'p99 ms', 'max ms'),
+        [[report[i] for i in ('requests', 'errors', 'rps', 'p50', 'p90', 'p95', 'p99', 'max')]]
+    )
+    print
+    for index, count in enumerate(histogram):
+        label = ('< %s ms' % LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS)
+                 else '>= %s ms' % LATENCY_BUCKETS[-1])
+        print label.rjust(12), str(count).rjust(8), colors.cyan(
+            '#' * int(60.0 * count / max(len(times), 1)))
+
+    target = re.sub(r'[^\w.-]+', '-', target)
+    with cwd(settings.root_path, '.builds'):
+        if baseline:
+            baseline_path = 'loadtest-%s-%s.json' % (baseline, target)
+        else:
+            baseline_path = max([
+                path for path in glob.glob('loadtest-*-%s.json' % target)
+                if path != 'loadtest-%s-%s.json' % (prj.build_name, target)
+            ] or [None], key=lambda path: path and os.path.getmtime(path))
+        with file('loadtest-%s-%s.json' % (prj.build_name, target), 'w') as fh:
+            json.dump(report, fh, indent=2)
+        if not baseline_path:
+            print colors.yellow("No baseline to compare with.")
+            return report
+        with file(baseline_path) as fh:
+            previous = json.load(fh)
+
+    regressions = []
+    if report['rps'] < previous['rps'] * (1 - threshold / 100):
+        regressions.append("req/s dropped from %s to %s" % (previous['rps'], report['rps']))
+    if report['p95'] > previous['p95'] * (1 + threshold / 100):
+        regressions.append("p95 went up from %s ms to %s ms" % (previous['p95'], report['p95']))
+    if regressions:
+        raise RuntimeError("Performance regression against %s (threshold %s%%): %s." % (
+            previous['build'], threshold, '; '.join(regressions)))
+    print colors.green("No regression against %s." % previous['build'])
+    return report
+
+SLOC_CACHE_FILE = '.builds/sloc-cache.json'
+SLOC_HISTORY_FILE = '.builds/sloc-history.jsonl'
+SLOC_LANGUAGES = {
+    # extension: (language, line comment, block comment delimiters)
+    '.py': ('python', '#', None),
+    '.js': ('javascript', '//', ('/*', '*/')),
+    '.css': ('css', None, ('/*', '*/')),
+    '.html': ('html', None, ('<!--', '-->')),
+    '.txt': ('text', None, None),
+}
+
+def sloc_files():
+    "The files from the METRICS paths that are counted (migrations are skipped)."
+    paths = []
+    for root in file(os.path.join(settings.root_path, 'METRICS')).read().split():
+        if os.path.isfile(root):
+            candidates = [root]
+        else:
+            candidates = (os.path.join(dirpath, name)
+                          for dirpath, _, filenames in os.walk(root)
+                          for name in filenames)
+        for path in candidates:
+            if os.path.splitext(path)[1].lower() not in SLOC_LANGUAGES:
+                continue
+            if path.endswith('.py') and '%smigrations%s' % (os.sep, os.sep) in path:
+                continue
+            paths.append(os.path.normpath(path))
+    return sorted(set(paths))
+
+def count_sloc(path):
+    "Returns (code, comment, blank) line counts for the file."
+    _, line_comment, block_comment = SLOC_LANGUAGES[os.path.splitext(path)[1].lower()]
+    code = comment = blank = 0
+    in_block = False
+    for line in open(path):
+        line = line.strip()
+        if in_block:
+            comment += 1
+            in_block = block_comment[1] not in line
+        elif not line:
+            blank += 1
+        elif line_comment and line.startswith(line_comment):
+            comment += 1
+        elif block_comment and line.startswith(block_comment[0]):
+            comment += 1
+            in_block = block_comment[1] not in line[len(block_comment[0]):]
+        else:
+            code += 1
+    return code, comment, blank
+
+def _sloc_worker(item):
+    path, cached_sha1 = item
+    with open(path, 'rb') as fh:
+        sha1 = hashlib.sha1(fh.read()).hexdigest()
+    # just touched, no need to count again
+    if sha1 == cached_sha1:
+        return path, sha1, None
+    return path, sha1, count_sloc(path)
+
+def sloc_report(format='table'):
+    """
+    Counts the lines of the METRICS files (in a process pool). The counts are
+    cached in .builds/sloc-cache.json by mtime, size and hash so only changed
+    files are scanned again. Each report is appended to .builds/sloc-history.jsonl.
+    """
+    from multiprocessing import Pool
+
+    with cwd(settings.root_path):
+        local('mkdir -p .builds', quiet=True)
+        cache = {}
+        if os.path.exists(SLOC_CACHE_FILE):
+            with open(SLOC_CACHE_FILE) as fh:
+                cache = json.load(fh)
+
+        counts = {}
+        stale = []
+        for path in sloc_files():
+            stat = os.stat(path)
+            entry = cache.get(path)
+            if entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                counts[path] = entry
+            else:
+                stale.append((path, entry and entry['sha1']))
+        if stale:
+            pool = Pool()
+            try:
+                scanned = pool.map(_sloc_worker, stale, chunksize=max(1, len(stale) // 32))
+            finally:
+                pool.close()
+            for path, sha1, lines in scanned:
+                stat = os.stat(path)
+                entry = counts[path] = dict(cache[path] if lines is None else zip(
+                    ('code', 'comment', 'blank'), lines
+                ))
+                entry.update(mtime=stat.st_mtime, size=stat.st_size, sha1=sha1)
+        with open(SLOC_CACHE_FILE, 'w') as fh:
+            json.dump(counts, fh)
+
+        languages = {}
+        for path, entry in counts.items():
+            language = SLOC_LANGUAGES[os.path.splitext(path)[1].lower()][0]
+            totals = languages.setdefault(language, dict(files=0, code=0, comment=0, blank=0))
+            totals['files'] += 1
+            for key in ('code', 'comment', 'blank'):
+                totals[key] += entry[key]
+        report = dict(
+            time=time.time(),
+            tag=prj.tag,
+            scanned=len(stale),
+            languages=languages,
+            total=dict((key, sum(i[key] for i in languages.values()))
+                       for key in ('files', 'code', 'comment', 'blank')),
+        )
+        with open(SLOC_HISTORY_FILE, 'a') as fh:
+            fh.write(json.dumps(report) + '\n')
+
+    if format == 'json':
+        print json.dumps(report, indent=2)
+    else:
+        rows = sorted(languages.items(), key=lambda item: -item[1]['code'])
+        rows.append(('TOTAL', report['total']))
+        print_table(
+            ('language', 'files', 'code', 'comment', 'blank'),
+            [[name, i['files'], i['code'], i['comment'], i['blank']] for name, i in rows]
+        )
+        print colors.blue("%s of %s files scanned, the rest were cached." % (
+            len(stale), len(counts)))
+    return report
+
+SUPERVISOR_FAILED_STATES = ('BACKOFF', 'FATAL')
+UWSGI_STATS_SCRIPT = '''
+import glob, json, os, socket, sys
+result = {}
+for path in glob.glob(os.path.expanduser(sys.argv[1])):
+    sock = socket.socket(socket.AF_UNIX)
+    try:
+        sock.settimeout(5)
+        sock.connect(path)
+        result[os.path.basename(path)] = json.loads(''.join(iter(lambda: sock.recv(65536), '')))
+    except Exception, exc:
+        result[os.path.basename(path)] = {'error': str(exc)}
+    finally:
+        sock.close()
+print json.dumps(result)
+'''
+
+def parse_supervisor_status(output):
+    processes = []
+    for line in output.splitlines():
+        parts = line.split(None, 2)
+        if len(parts) >= 2:
+            processes.append(dict(name=parts[0], state=parts[1],
+                                  info=parts[2].strip() if len(parts) > 2 else ''))
+    return processes
+
+@parallel
+def collect_status():
+    """
+    Returns the supervisor processes of the role on the current host with
+    their uwsgi stats (from the --stats sockets) and the host's load average.
+    """
+    prefix = '%s-%s-' % (settings.project_name, env.role)
+    with ctx.settings(ctx.hide('stdout', 'running')):
+        processes = [
+            process for process in parse_supervisor_status(
+                silentrun("supervisorctl status", use_sudo=True))
+            if process['name'].startswith(prefix)
+        ]
+        load = ops.run("cat /proc/loadavg").split()[:3]
+        stats = json.loads(ops.run(
+            "python -c \"import base64; exec(base64.b64decode('%s'))\" '~/run/%s*.stats.sock'" % (
+                base64.b64encode(UWSGI_STATS_SCRIPT), prefix
+            )
+        ))
+    for process in processes:
+        process.update(host=env.host, load=' '.join(load))
+        uwsgi = stats.get('%s.stats.sock' % process['name'])
+        if not uwsgi:
+            continue
+        if 'error' in uwsgi:
+            process['stats_error'] = uwsgi['error']
+            continue
+        workers = uwsgi.get('workers', [])
+        process.update(
+            workers=len(workers),
+            busy=len([worker for worker in workers if worker.get('status') == 'busy']),
+            rss_mb=round(sum(worker.get('rss', 0) for worker in workers) / 1048576.0, 1),
+            max_rss_mb=round(max([worker.get('rss', 0) for worker in workers] or [0]) / 1048576.0, 1),
+            respawns=sum(worker.get('respawn_count', 0) for worker in workers),
+            requests=sum(worker.get('requests', 0) for worker in workers),
+            listen_queue=uwsgi.get('listen_queue', 0),
+        )
+    return processes
+
+@task
+@runs_once
+@require_role
+def status(format='table'):
+    """
+    Supervisor states, uwsgi worker stats and load for all the hosts in the role. Fails if there are BACKOFF or FATAL programs. Eg: fab -R prod status; fab -R prod status:json
+    """
+    processes = [process for host_processes in execute(collect_status, roles=[env.role]).values()
+                 for process in host_processes]
+    processes.sort(key=lambda process: (process['host'], process['name']))
+    if format == 'json':
+        print json.dumps(processes, indent=2)
+    else:
+        columns = ('host', 'name', 'state', 'workers', 'busy', 'rss_mb', 'max_rss_mb',
+                   'respawns', 'listen_queue', 'requests', 'load')
+        print_table(
+            ('host', 'program', 'state', 'workers', 'busy', 'rss MB', 'max rss MB',
+             'respawns', 'listen queue', 'requests', 'load'),
+            [[process.get(column, '-') for column in columns] for process in processes]
+        )
+    failed = ["%(name)s on %(host)s (%(state)s)" % process for process in processes
+              if process['state'] in SUPERVISOR_FAILED_STATES]
+    if failed:
+        raise RuntimeError("Failed programs: %s" % ', '.join(failed))
+    return processes
+
+@parallel
+def fetch_memtrack(days=7):
+    """
+    Download the memtrack snapshots (MEMTRACK in env.roleconfig) of the role
+    from the current host, removing the ones older than `days` on the host.
+    Returns the local directory or None if there are no snapshots.
+    """
+    import tarfile
+    directory = 'memtrack-%s' % env.role
+    remote_path = '/tmp/%s.%s.tar.gz' % (directory, os.getpid())
+    local_dir = os.path.join(settings.root_path, 'download', 'memtrack', env.host)
+    with ctx.cd('~/logs'):
+        if silentrun('test -d %s' % directory).failed:
+            return
+        if int(days):
+            ops.run('find %s -name "*.json" -mtime +%s -delete' % (directory, int(days)))
+        ops.run('tar czf %s %s' % (remote_path, directory))
+    try:
+        ops.get(remote_path, local_dir + '.tar.gz')
+    finally:
+        ops.run('rm -f %s' % remote_path)
+    if os.path.isdir(local_dir):
+        rmtree(local_dir)
+    with closing(tarfile.open(local_dir + '.tar.gz')) as archive:
+        archive.extractall(local_dir)
+    os.unlink(local_dir + '.tar.gz')
+    return os.path.join(local_dir, directory)
+
+def read_memtrack(directory):
+    "Returns {pid: {'first': snapshot, 'last': snapshot}} from a memtrack directory."
+    workers = {}
+    for name in os.listdir(directory):
+        if name.endswith('.json'):
+            pid, kind = name[:-len('.json')].rsplit('-', 1)
+            with open(os.path.join(directory, name)) as fh:
+                workers.setdefault(pid, {})[kind] = json.load(fh)
+    return workers
+
+@task
+@runs_once
+@require_role
+def memory_report(top=25, days=7, format='table'):
+    """
+    Rank the allocation sites and urls by memory growth from the memtrack snapshots of all the hosts in the role. Eg: fab -R prod memory_report:top=50
+    """
+    top = int(top)
+    hosts, sites, paths = [], {}, {}
+    tracers = set()
+    for host, directory in sorted(execute(fetch_memtrack, days=days, roles=[env.role]).items()):
+        if not directory:
+            continue
+        workers = read_memtrack(directory)
+        snapshots = [worker.get('last') or worker['first'] for worker in workers.values()]
+        hosts.append({
+            'host': host,
+            'workers': len(workers),
+            'near_rss_limit': len([s for s in snapshots if s['reason'] == 'rss-limit']),
+            'exited': len([s for s in snapshots if s['reason'] == 'exit']),
+            'requests_per_worker': sum(s['requests'] for s in snapshots) // len(snapshots) if snapshots else 0,
+            'max_rss_mb': round(max(s['rss'] for s in snapshots) / 1048576.0, 1) if snapshots else 0,
+        })
+        for snapshot in snapshots:
+            tracers.add(snapshot['tracer'])
+            for path, (requests, growth, biggest) in snapshot['paths'].items():
+                stats = paths.setdefault(path, {'path': path, 'requests': 0, 'growth': 0, 'max': 0})
+                stats['requests'] += requests
+                stats['growth'] += growth
+                stats['max'] = max(stats['max'], biggest)
+        # growth between the first snapshot (after warm-up) and the last, per worker
+        for worker in workers.values():
+            if 'first' not in worker or 'last' not in worker:
+                continue
+            first, last = worker['first']['sites'], worker['last']['sites']
+            for site in set(first) | set(last):
+                size, count = last.get(site, (0, 0))
+                first_size, first_count = first.get(site, (0, 0))
+                stats = sites.setdefault(site, {'site': site, 'size': 0, 'count': 0, 'workers': 0})
+                stats['size'] += size - first_size
+                stats['count'] += count - first_count
+                stats['workers'] += 1
+
+    if not hosts:
+        print colors.red("No memtrack snapshots (set MEMTRACK in env.roleconfig[%r] and deploy)." % env.role)
+        return
+    # sites are file:line with tracemalloc (sizes) and types with gc (object counts only)
+    by_size = tracers == set(['tracemalloc'])
+    ranked_sites = sorted(sites.values(), key=lambda s: -(s['size'] if by_size else s['count']))[:top]
+    ranked_paths = sorted(paths.values(), key=lambda p: -p['growth'])[:top]
+    if format == 'json':
+        print json.dumps({'hosts': hosts, 'sites': ranked_sites, 'paths': ranked_paths}, indent=2)
+        return
+    print_table(
+        ('host', 'workers', 'near rss limit', 'exited', 'requests/worker', 'max rss MB'),
+        [(h['host'], h['workers'], h['near_rss_limit'], h['exited'], h['requests_per_worker'],
+          h['max_rss_mb']) for h in hosts]
+    )
+    print
+    print_table(
+        ('allocation site' if by_size else 'type', 'growth KB', 'objects', 'workers'),
+        [(s['site'], s['size'] // 1024, '%+d' % s['count'], s['workers']) for s in ranked_sites]
+    )
+    print
+    print_table(
+        ('url', 'requests', 'growth KB', 'per request B', 'max KB'),
+        [(p['path'], p['requests'], p['growth'] // 1024, p['growth'] // max(p['requests'], 1),
+          p['max'] // 1024) for p in ranked_paths]
+    )
+
+# Runs in a fresh interpreter: loads the app like app.wsgi does (and what the
+# first request loads: middleware and urls) with a timing __import__ hook.
+# Prints the result as JSON on the last line.
+STARTUP_PROFILE_SCRIPT = '''
+import time
+started = time.time()
+import __builtin__, json, sys
+original_import = __builtin__.__import__
+root = {'name': '', 'children': []}
+stack = [root]
+
+def timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    node = {'name': name, 'children': []}
+    count = len(sys.modules)
+    stack.append(node)
+    start = time.time()
+    try:
+        return original_import(name, globals, locals, fromlist, level)
+    finally:
+        node['cumulative'] = time.time() - start
+        stack.pop()
+        if len(sys.modules) != count:
+            package = (globals or {}).get('__package__') or ((globals or {}).get('__name__') or '').rpartition('.')[0]
+            if name not in sys.modules and package + '.' + name in sys.modules:
+                node['name'] = package + '.' + name
+            node['self'] = node['cumulative'] - sum(child['cumulative'] for child in node['children'])
+            stack[-1]['children'].append(node)
+__builtin__.__import__ = timed_import
+
+phases = []
+def phase(name, function):
+    start = time.time()
+    function()
+    phases.append((name, time.time() - start))
+
+def load_django():
+    import django.core.handlers.wsgi
+def load_settings():
+    from django.conf import settings
+    settings.INSTALLED_APPS
+def load_handler():
+    import django.core.handlers.wsgi
+    django.core.handlers.wsgi.WSGIHandler().load_middleware()
+def load_urls():
+    from django.core.urlresolvers import get_resolver
+    get_resolver(None).url_patterns
+def load_models():
+    from django.db.models.loading import get_models
+    get_models()
+
+phase('django', load_django)
+phase('settings', load_settings)
+phase('handler', load_handler)
+phase('urls', load_urls)
+phase('models', load_models)
+print(json.dumps({'total': time.time() - started, 'phases': phases, 'tree': root['children']}))
+'''
+
+def flatten_import_tree(nodes, modules=None):
+    "Returns {module: {'cumulative': seconds, 'self': seconds}} from an import tree."
+    if modules is None:
+        modules = {}
+    for node in nodes:
+        stats = modules.setdefault(node['name'], {'cumulative': 0.0, 'self': 0.0})
+        stats['cumulative'] += node['cumulative']
+        stats['self'] += node['self']
+        flatten_import_tree(node['children'], modules)
+    return modules
+
+@task
+def startup_profile(repeat=3, threshold=20, module_threshold=50, min_ms=10, top=25, baseline=None):
+    """
+    Profile the app's cold start (imports per module) in clean interpreters, compare with the previous build. Eg: fab startup_profile; fab environment:prod startup_profile
+    """
+    repeat, threshold, module_threshold, min_ms = int(repeat), float(threshold), float(module_threshold), float(min_ms)
+    command = '-B -c "import base64; exec(base64.b64decode(\'%s\'))"' % base64.b64encode(STARTUP_PROFILE_SCRIPT)
+    runs = []
+    with cwd(settings.root_path):
+        local('mkdir -p .builds')
+        print colors.blue("Profiling the startup for %s (%s runs) ..." % (settings.environment, repeat))
+        for _ in range(repeat):
+            runs.append(json.loads(python(command, capture=True).splitlines()[-1]))
+    # the fastest run has the least noise
+    best = min(runs, key=lambda run: run['total'])
+    modules = {}
+    for run in runs:
+        for name, stats in flatten_import_tree(run['tree']).items():
+            if name not in modules or stats['cumulative'] < modules[name]['cumulative']:
+                modules[name] = stats
+    report = dict(
+        build=prj.build_name,
+        environment=settings.environment,
+        total=best['total'],
+        phases=best['phases'],
+        modules=modules,
+        tree=best['tree'],
+    )
+
+    with cwd(settings.root_path, '.builds'):
+        name = 'startup-%s-%s.json' % (prj.build_name, settings.environment)
+        if baseline:
+            baseline_path = 'startup-%s-%s.json' % (baseline, settings.environment)
+        else:
+            baseline_path = max([
+                path for path in glob.glob('startup-*-%s.json' % settings.environment) if path != name
+            ] or [None], key=lambda path: path and os.path.getmtime(path))
+        with file(name, 'w') as fh:
+            json.dump(report, fh, indent=2)
+        previous = None
+        if baseline_path:
+            with file(baseline_path) as fh:
+                previous = json.load(fh)
+
+    def ms(seconds):
+        return '-' if seconds is None else '%.1f' % (seconds * 1000)
+
+    def change(seconds, before):
+        return '-' if before is None else '%+.1f' % ((seconds - before) * 1000)
+
+    previous_modules = previous['modules'] if previous else {}
+    print_table(
+        ('phase', 'ms'),
+        [(phase, ms(seconds)) for phase, seconds in report['phases']] + [('total', ms(report['total']))]
+    )
+    print
+    print_table(
+        ('module', 'cumulative ms', 'self ms', 'previous ms', 'change ms'),
+        [(name, ms(stats['cumulative']), ms(stats['self']),
+          ms(previous_modules.get(name, {}).get('cumulative')),
+          change(stats['cumulative'], previous_modules.get(name, {}).get('cumulative')))
+         for name, stats in sorted(modules.items(), key=lambda item: -item[1]['cumulative'])[:int(top)]]
+    )
+    if not previous:
+        print colors.yellow("No baseline to compare with.")
+        return report
+
+    regressions = []
+    if report['total'] > previous['total'] * (1 + threshold / 100):
+        regressions.append("startup went up from %s ms to %s ms" % (ms(previous['total']), ms(report['total'])))
+    for name, stats in sorted(modules.items()):
+        before = previous_modules.get(name, {}).get('cumulative', 0)
+        if (stats['cumulative'] - before) * 1000 > min_ms and \
+                stats['cumulative'] > before * (1 + module_threshold / 100):
+            regressions.append("%s went up from %s ms to %s ms" % (name, ms(before), ms(stats['cumulative'])))
+    if regressions:
+        raise RuntimeError("Startup regression against %s (threshold %s%%, %s%% per import): %s." % (
+            previous['build'], threshold, module_threshold, '; '.join(regressions)))
+    print colors.green("No regression against %s." % previous['build'])
+    return report
+
+DEPLOY_HISTORY_FILE = '.builds/deploy-history.json'
+DEPLOY_HISTORY_SIZE = 200
+
+def read_deploy_history():
+    path = os.path.join(settings.root_path, DEPLOY_HISTORY_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path) as fh:
+        return json.load(fh)
+
+def record_deploy(function):
+    """
+    Record the phase timings of the decorated deploy task (per host) in
+    DEPLOY_HISTORY_FILE, failed deploys included.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        deploy_timer.start()
+        started = time.time()
+        status = 'failed'
+        try:
+            result = function(*args, **kwargs)
+            status = 'ok'
+            return result
+        finally:
+            phases = deploy_timer.stop()
+            history = read_deploy_history()
+            history.append(dict(
+                build=prj.build_name,
+                role=env.role,
+                host=env.host,
+                started=started,
+                status=status,
+                wall=time.time() - started,
+                phases=phases,
+            ))
+            with cwd(settings.root_path):
+                local('mkdir -p .builds')
+                with open(DEPLOY_HISTORY_FILE, 'w') as fh:
+                    json.dump(history[-DEPLOY_HISTORY_SIZE:], fh, indent=2)
+    return wrapper
+
+@task
+@runs_once
+def deploy_report(last=5, role=None, format='table'):
+    """
+    Compare the phase timings, remote round trips and transfers of the recent deploys. Eg: fab deploy_report; fab deploy_report:10,role=prod
+    """
+    deploys = [deploy for deploy in read_deploy_history()
+               if not role and not env.roles or deploy['role'] in ([role] if role else env.roles)][-int(last):]
+    if format == 'json':
+        print json.dumps(deploys, indent=2)
+        return deploys
+    if not deploys:
+        print colors.yellow("No deploys recorded in %s." % DEPLOY_HISTORY_FILE)
+        return deploys
+
+    phases = []
+    for deploy in deploys:
+        for name, _ in sorted(deploy['phases'].items(), key=lambda item: -item[1]['wall']):
+            if name not in phases:
+                phases.append(name)
+
+    def total(deploy, key):
+        return sum(stats[key] for stats in deploy['phases'].values())
+
+    def row(label, value, fmt):
+        cells = [label]
+        for deploy in deploys:
+            cells.append(fmt % value(deploy) if value(deploy) is not None else '-')
+        # change of the last deploy against the previous one
+        if len(deploys) > 1 and value(deploys[-1]) is not None and value(deploys[-2]) is not None:
+            cells.append('%+.1f' % (value(deploys[-1]) - value(deploys[-2])))
+        else:
+            cells.append('-')
+        return cells
+
+    rows = [['status'] + [deploy['status'] for deploy in deploys] + ['']]
+    for name in phases:
+        # "other" (remote commands outside the timed phases) only has counts
+        rows.append(row(name + ' s', lambda deploy: deploy['phases'].get(name, {}).get('wall')
+                        if deploy['phases'].get(name, {}).get('calls') else None, '%.1f'))
+    rows.append(row('total s', lambda deploy: deploy['wall'], '%.1f'))
+    rows.append(row('round trips', lambda deploy: total(deploy, 'round_trips'), '%d'))
+    rows.append(row('uploaded MB', lambda deploy: total(deploy, 'bytes_up') / 1048576.0, '%.1f'))
+    rows.append(row('downloaded MB', lambda deploy: total(deploy, 'bytes_down') / 1048576.0, '%.1f'))
+    print_table(
+        ['phase'] + ['%s %s@%s %s' % (deploy['build'][len(settings.project_name) + 1:], deploy['role'],
+                                      deploy['host'], time.strftime('%m-%d %H:%M', time.localtime(deploy['started'])))
+                     for deploy in deploys] + ['change'],
+        rows
+    )
+    return deploys